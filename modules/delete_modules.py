@@ -39,6 +39,7 @@ Example command lines:
             --modules com.inkling.samples.sample-patterns \
             com.inkling.samples.sample-widgets
     ./delete_modules -c <config file>
+    ./delete_modules -j 8 -c <config file>
 """
 
 from __future__ import print_function
@@ -66,6 +67,8 @@ parser.add_argument('-e', '--environment', choices=['stable', 'testing'],
     default='stable')
 parser.add_argument('-n', '--dry-run', action='store_true', default=False,
     help='Dry run performing no svn delete or commit')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of '
+    'repos to check out or update concurrently')
 
 s9logging.configureLogging()
 log = logging.getLogger(__name__)
@@ -105,19 +108,21 @@ if __name__ == '__main__':
         args.repos] if args.repos else []
     repoSpecs = repoSpecs + _getRepoSpecsFromCsv()
 
+    repos = svn.ensureRepos([spec[:2] for spec in repoSpecs],
+        svn.MODULES_UPDATE_SPECS, jobs=args.jobs)
+
     for repoName, environment, moduleNames in repoSpecs:
-        try:
-            repo = svn.ensureRepo(repoName, svn.MODULES_UPDATE_SPECS,
-                environment=environment)
-        except svn.SvnError as e:
-            log.error(e.message + '\n')
+        repo = repos[(repoName, environment)]
+        if 'message' in repo:
+            log.error(repo['message'] + '\n')
             continue
 
         print('Deleting the following modules from "%s":' %
             repo['path'])
-        info = list_modules.getModuleInfo(repo['path'])
+        info = list_modules.getModuleInfo(repo['path'], repo['state'])
 
         performedDelete = False
+        deletedPaths = []
 
         for module in info:
             if module['name'] in moduleNames:
@@ -128,6 +133,7 @@ if __name__ == '__main__':
                 else:
                     try:
                         svn.delete(module['systemPath'])
+                        deletedPaths.append(module['systemPath'])
                         performedDelete = True
                         print('\t', module['name'])
                     except svn.SvnError as e:
@@ -141,7 +147,8 @@ if __name__ == '__main__':
                 else:
                     try:
                         svn.commit(repo['path'], 'Deleting modules with '
-                                   'delete_modules.py script')
+                                   'delete_modules.py script',
+                                   paths=deletedPaths)
                     except svn.SvnError as e:
                         log.error(e.message + '\n')
 
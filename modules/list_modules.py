@@ -26,6 +26,10 @@ This script will locally check out only the module directories of every relevant
 project svn repo. If the repo is already checked out you can substitute the path
 to the repo for the repo shortname and the environment will be ignored.
 
+With --remote nothing is checked out. Each project's modules are listed and
+their module.json files read straight from the SVN server, and projects must be
+given by shortname.
+
 Configuration files must be a CSV in the form of:
 repo1_shortname,repo1_environment
 repo2_shortname,repo2_environment
@@ -34,6 +38,9 @@ Example command lines:
     ./list_modules -e testing andys_test_projec
     ./list_modules andys_test_project-testing/
     ./list_modules -c <config file>
+    ./list_modules -j 8 -c <config file>
+    ./list_modules -c <config file> --format csv -o modules.csv
+    ./list_modules -r -j 8 -c <config file>
 """
 
 from __future__ import print_function
@@ -42,9 +49,11 @@ import argparse
 import csv
 import json
 import logging
-import os
 import sys
 
+from multiprocessing.pool import ThreadPool
+
+import module_index
 from s9logging import s9logging
 import svn.project_svn as svn
 
@@ -56,37 +65,131 @@ parser.add_argument('-c', '--config', help='CSV file specifying repos and '
     'environments, each row in the form "shortname,environment"')
 parser.add_argument('-e', '--environment', choices=['stable', 'testing'],
     default='stable')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of '
+    'repos to check out or update concurrently')
+parser.add_argument('-r', '--remote', action='store_true', default=False,
+    help='Whether to read modules from the SVN server without checking out '
+    'the projects')
+parser.add_argument('-f', '--format', choices=['text', 'json', 'csv'],
+    default='text', help='Output format of the module listing')
+parser.add_argument('-o', '--output', help='File to write the module listing '
+    'to instead of standard output, which is shared with log messages')
 
 s9logging.configureLogging()
 log = logging.getLogger(__name__)
 
-MODULE_CONFIG_FILE = 'module.json'
+# Columns of the CSV output format.
+CSV_FIELDS = ['project', 'name', 'version', 'systemPath']
 
 
-def getModuleInfo(projectPath):
+def getModuleInfo(projectPath, state=None):
     """Returns a list of the project's modules' module.json as a dict, with an
     extra 'systemPath' property added for module path.
+
+    Module configs are read through the working copy's module index, so only
+    modules changed since the last call are read.
+
+    Args:
+        projectPath - String absolute path to the project.
+        state - Optional svn.RepoState of the project. When given, the index
+            is also invalidated when the modules directory revision changes.
     """
-    moduleInfo = []
-    moduleDir = os.path.join(projectPath, svn.PROJECT_MODULE_DIR)
-    if not os.path.isdir(moduleDir):
-        return moduleInfo
-
-    modules = os.listdir(moduleDir)
-
-    for module in modules:
-        jsonPath = os.path.join(projectPath, svn.PROJECT_MODULE_DIR, module,
-            MODULE_CONFIG_FILE)
-        if os.path.exists(jsonPath):
-            with open(jsonPath) as json_data:
-                data = json.load(json_data)
-                data['systemPath'] = os.path.join(projectPath,
-                    svn.PROJECT_MODULE_DIR, module)
-                moduleInfo.append(data)
+    return module_index.getModules(projectPath, _getModulesRevision(state))
+
+
+def getModuleFingerprint(projectPath, module, state=None):
+    """Returns a fingerprint of the content of a module's directory. Modules
+    with the same fingerprint are identical.
+
+    Args:
+        projectPath - String absolute path to the project.
+        module - String name of the module directory.
+        state - Optional svn.RepoState of the project, as for getModuleInfo.
+    """
+    return module_index.getTreeFingerprint(projectPath, module,
+        _getModulesRevision(state))
+
+
+def _getModulesRevision(state):
+    """Returns the revision of the modules directory in state, or None.
+    """
+    if state is not None:
+        node = state.getNode(svn.PROJECT_MODULE_DIR)
+        if node is not None:
+            return node['revision']
+    return None
+
+
+def getRemoteModuleInfo(projectUrl):
+    """Returns a list of the project's modules' module.json as a dict, read
+    from the SVN server without a working copy. An extra 'systemPath' property
+    is added for the module URL.
+
+    The modules are listed with one 'svn list' call and all module.json files
+    read with one 'svn cat' call. If some module has no readable module.json
+    each is read on its own instead.
+
+    Args:
+        projectUrl - String URL of the project trunk.
+    """
+    moduleDirUrl = projectUrl + '/' + svn.PROJECT_MODULE_DIR
+    moduleUrls = [moduleDirUrl + '/' + path.rstrip('/')
+        for path in svn.listPaths(moduleDirUrl, depth='immediates')
+        if path.endswith('/')]
+    if not moduleUrls:
+        return []
+
+    configUrls = [moduleUrl + '/' + module_index.MODULE_CONFIG_FILE
+        for moduleUrl in moduleUrls]
+    try:
+        configs = _decodeConcatenatedJson(svn.cat(configUrls).decode('utf8'))
+        if len(configs) != len(configUrls):
+            raise ValueError('Expected %d module configs, read %d' % (
+                len(configUrls), len(configs)))
+    except (svn.SvnError, ValueError) as e:
+        log.debug('Reading module configs one at a time: %s', e)
+        configs = []
+        for configUrl in configUrls:
+            try:
+                configs.append(json.loads(svn.cat([configUrl]).decode('utf8')))
+            except (svn.SvnError, ValueError):
+                configs.append(None)
 
+    moduleInfo = []
+    for moduleUrl, data in zip(moduleUrls, configs):
+        if data is not None:
+            data['systemPath'] = moduleUrl
+            moduleInfo.append(data)
     return moduleInfo
 
 
+def _decodeConcatenatedJson(content):
+    """Returns the list of JSON values in content, one after another.
+    """
+    decoder = json.JSONDecoder()
+    values = []
+    index = 0
+    while True:
+        while index < len(content) and content[index].isspace():
+            index += 1
+        if index == len(content):
+            return values
+        value, index = decoder.raw_decode(content, index)
+        values.append(value)
+
+
+def _getRemoteListing(repoSpec):
+    """Returns a tuple of the project URL, its module info, and an error
+    message if the modules couldn't be read, otherwise None.
+    """
+    name, environment = repoSpec
+    projectUrl = svn.getProjectUrl(name, environment)
+    try:
+        return projectUrl, getRemoteModuleInfo(projectUrl), None
+    except svn.SvnError as e:
+        return projectUrl, [], e.message
+
+
 def _getRepoSpecsFromCsv():
     """Returns a list of tuples of the form (source name, source environment)
     taken from the CSV configuration file if one was specified.
@@ -111,6 +214,48 @@ def _getRepoSpecsFromCsv():
 
     return results
 
+def _writeListing(listing, outputFile):
+    """Writes the module listing in the format specified by the arguments.
+
+    Args:
+        listing - List of (project path, module info list) tuples.
+        outputFile - File object to write to.
+    """
+    if args.format == 'json':
+        json.dump([{
+            'project': projectPath,
+            'modules': [{
+                'name': data['name'],
+                'version': data['version'],
+                'systemPath': data['systemPath']
+            } for data in info]
+        } for projectPath, info in listing], outputFile, indent=2)
+        outputFile.write('\n')
+    elif args.format == 'csv':
+        writer = csv.writer(outputFile)
+        writer.writerow(CSV_FIELDS)
+        for projectPath, info in listing:
+            for data in info:
+                writer.writerow([_encode(value) for value in [projectPath,
+                    data['name'], data['version'], data['systemPath']]])
+    else:
+        for projectPath, info in listing:
+            print('Project:', projectPath, file=outputFile)
+            if len(info) > 0:
+                for data in info:
+                    print('\t' + data['name'] + ' v' + data['version'],
+                        file=outputFile)
+                print('', file=outputFile)
+            else:
+                print('\tNo modules\n', file=outputFile)
+
+def _encode(value):
+    """Returns value as a byte string for the Python 2 csv module.
+    """
+    if not isinstance(value, str):
+        return value.encode('utf8')
+    return value
+
 if __name__ == '__main__':
     args = parser.parse_args()
 
@@ -120,19 +265,35 @@ if __name__ == '__main__':
     repoSpecs = [(name, args.environment) for name in args.repos] + \
             _getRepoSpecsFromCsv()
 
-    for name, environment in repoSpecs:
+    listing = []
+    if args.remote:
+        # Read projects concurrently, keeping the output in order.
+        pool = ThreadPool(max(args.jobs, 1))
         try:
-            repo = svn.ensureRepo(name, svn.MODULES_UPDATE_SPECS,
-                environment=environment)
-        except svn.SvnError as e:
-            log.error(e.message + '\n')
-            continue
-
-        print('Project:', repo['path'])
-        info = getModuleInfo(repo['path'])
-        if len(info) > 0:
-            for data in info:
-                print('\t' + data['name'] + ' v' + data['version'])
-            print('')
-        else:
-            print('\tNo modules\n')
+            remoteListing = pool.map(_getRemoteListing, repoSpecs)
+        finally:
+            pool.close()
+
+        for projectUrl, info, message in remoteListing:
+            if message is not None:
+                log.error(message + '\n')
+                continue
+            listing.append((projectUrl, info))
+    else:
+        repos = svn.ensureRepos(repoSpecs, svn.MODULES_UPDATE_SPECS,
+            jobs=args.jobs)
+
+        for name, environment in repoSpecs:
+            repo = repos[(name, environment)]
+            if 'message' in repo:
+                log.error(repo['message'] + '\n')
+                continue
+
+            listing.append((repo['path'],
+                getModuleInfo(repo['path'], repo['state'])))
+
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            _writeListing(listing, outputFile)
+    else:
+        _writeListing(listing, sys.stdout)
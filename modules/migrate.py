@@ -27,7 +27,10 @@ This script will check out the entire trunk of a project repo. It must do this
 to ensure it correctly fixes all relative paths referenced from a widget. This
 can be slow! If the repo is already checked out you can substitute the path
 to the repo for the repo shortname and the existing svn repository will be
-re-used and the environment will be ignored.
+re-used and the environment will be ignored. With --sparse only the content and
+the migrating widgets and modules are checked out, relative paths are checked
+against a listing of the repository, and widget config files are fetched
+before they are updated.
 
 This script uses a series of very targetted, programatically generated regular
 expressions to do the actual content migration. As a result the diff is very
@@ -47,22 +50,51 @@ directory name is relative to /assets/modules, e.g.,
 
 sn_test_project,stable,flashcard,inkling.flashcard
 
+Rows for the same project are migrated together, so each content file is read
+and written once and each project gets a single commit.
+
 Example command lines:
     migrate.py -c migrate.csv
     migrate.py -c migrate.csv -s
+    migrate.py -c migrate.csv -j 8
+    migrate.py -c migrate.csv --sparse
 """
 
 import argparse
 import codecs
+import collections
 import csv
 import glob
 import json
 import logging
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
 import subprocess
-
-from bs4 import BeautifulSoup
+import sys
+
+try:
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+
+try:
+    from html import escape, unescape
+except ImportError:
+    from cgi import escape
+    unescape = HTMLParser().unescape
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 has scandir as a separate package. Without it HTML files are
+    # found with os.walk.
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from s9logging import s9logging
 import svn.project_svn as svn
@@ -74,10 +106,48 @@ parser.add_argument('-c', '--config', required=True, help='CSV file specifying '
     'repo_shortname,environment,widget_directory_name,module_directory_name"')
 parser.add_argument('-s', '--skip-commit', action='store_true', default=False,
     help='Whether to skip svn commit of project changes')
+parser.add_argument('--sparse', action='store_true', default=False,
+    help='Whether to check out only the content, migrating widgets and modules '
+    'and the widget config files they use, rather than the whole project')
+parser.add_argument('--streaming', action='store_true', default=False,
+    help='Whether to scan content files in chunks rather than reading each '
+    'whole, so memory use doesn\'t grow with the size of very large files')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of '
+    'processes parsing and updating content files concurrently')
 
 s9logging.configureLogging()
 log = logging.getLogger(__name__)
 
+# The attributes of a start tag, whose quoted values may contain '>'.
+TAG_ATTRIBUTES_PATTERN = r'[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*'
+
+# Comments and <script> and <style> elements, which are skipped as a parser
+# would, start tags of <object> and <param> elements, and </object> end tags.
+OBJECT_TAG_PATTERN = re.compile(r'<!--.*?(?:-->|\Z)'
+    r'|<(script|style)\b' + TAG_ATTRIBUTES_PATTERN + r'>.*?(?:</\1\s*>|\Z)'
+    r'|<(object|param)\b' + TAG_ATTRIBUTES_PATTERN + r'>|</object\s*>',
+    re.IGNORECASE | re.DOTALL)
+
+# Files at least this many bytes are memory mapped rather than read when
+# checking whether they reference a widget.
+MMAP_THRESHOLD = 1024 * 1024
+
+# Seconds to wait for a result before checking that no worker process died.
+WORKER_CHECK_INTERVAL = 5
+
+# Characters read at a time when streaming content files.
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+# A pattern in the pattern snippets file: the comment naming it, its <script>
+# tag, the script body and closing tag. Whitespace before the comment is part
+# of the pattern so removing it doesn't leave blank lines behind.
+PATTERN_BLOCK_PATTERN = re.compile(r'(\s*)(<!--(?:(?!-->).)*-->\s*)?'
+    r'(<script\b[^>]*>)(.*?)(</script\s*>)', re.DOTALL | re.IGNORECASE)
+
+# Attributes with a quoted or unquoted value within a start tag.
+ATTRIBUTE_PATTERN = re.compile(
+    r'([^\s"\'>/=]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+))')
+
 def _getSpecsFromCsv():
     """Returns a list of tuples of the form (source name, source environment,
     widget directory name, module directory name) taken from the CSV
@@ -102,75 +172,430 @@ def _getSpecsFromCsv():
     return results
 
 
-def _getAllHTMLFiles(rootDir):
-    """Returns a list of all HTML files under the root directory.
+class PathIndex(object):
+    """An in-memory index of every file and directory in a repo, read with one
+    walk of the tree so checking whether a path exists doesn't stat the
+    (often network mounted) volume.
+
+    Lookups are case-insensitive when the indexed volume is, as the
+    os.path.exists calls they stand in for are, e.g. on a default macOS
+    volume.
+
+    Attributes:
+        root - String absolute path of the indexed directory.
+    """
+
+    def __init__(self, root, relativePaths=None):
+        """Indexes the directory tree at root, or if relativePaths is given,
+        those paths under root instead, e.g. a listing of the repository for
+        a sparse working copy.
+        """
+        # Walk with a unicode root so names compare equal to the unicode paths
+        # read from content and config files.
+        self.root = _toUnicode(os.path.normpath(root))
+        self._caseInsensitive = _isCaseInsensitive(self.root)
+        if relativePaths is not None:
+            self._paths = set(self._getKey(os.path.normpath(_toUnicode(path)))
+                for path in relativePaths)
+            return
+
+        self._paths = set()
+        if scandir is None:
+            for dirPath, dirs, files in os.walk(self.root):
+                if '.svn' in dirs:
+                    dirs.remove('.svn')
+                relativeDir = os.path.relpath(dirPath, self.root)
+                for name in dirs + files:
+                    self._paths.add(self._getKey(os.path.normpath(
+                        os.path.join(relativeDir, name))))
+            return
+
+        # scandir gets each entry's type from the directory listing, so
+        # nothing is stat'd.
+        directories = ['']
+        while directories:
+            relativeDir = directories.pop()
+            for entry in scandir(os.path.join(self.root, relativeDir)):
+                if entry.name == '.svn':
+                    continue
+                relativePath = os.path.join(relativeDir, entry.name)
+                self._paths.add(self._getKey(relativePath))
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(relativePath)
+
+    def exists(self, path):
+        """Returns whether the absolute path exists. Paths outside the indexed
+        directory are checked on disk.
+        """
+        relativePath = self._getRelativePath(path)
+        if relativePath is None:
+            return os.path.exists(path)
+        return relativePath == '.' or relativePath in self._paths
+
+    def remove(self, path):
+        """Records that the absolute path and everything under it no longer
+        exist.
+        """
+        relativePath = self._getRelativePath(path)
+        if relativePath in (None, '.'):
+            return
+        prefix = relativePath + os.sep
+        self._paths = set(indexed for indexed in self._paths
+            if indexed != relativePath and not indexed.startswith(prefix))
+
+    def _getKey(self, relativePath):
+        """Returns the form of a normalized relative path kept in the index."""
+        relativePath = os.path.normcase(relativePath)
+        if self._caseInsensitive:
+            return relativePath.lower()
+        return relativePath
+
+    def _getRelativePath(self, path):
+        """Returns the index key of the absolute path, or None if it's outside
+        the indexed directory.
+        """
+        relativePath = os.path.relpath(_toUnicode(os.path.normpath(path)),
+            self.root)
+        if relativePath == os.pardir or relativePath.startswith(
+                os.pardir + os.sep):
+            return None
+        return self._getKey(relativePath)
+
+
+def _isCaseInsensitive(path):
+    """Returns whether the volume holding the existing directory at path
+    matches names case-insensitively, by looking the path up with the case of
+    its last cased component swapped.
+    """
+    path = os.path.abspath(path)
+    while True:
+        parentPath, name = os.path.split(path)
+        if name.swapcase() != name:
+            swappedPath = os.path.join(parentPath, name.swapcase())
+            try:
+                return os.path.samefile(path, swappedPath)
+            except OSError:
+                return False
+        if parentPath == path:
+            return False
+        path = parentPath
+
+
+def _getSparseSpecs(widgetSpecs):
+    """Returns the SVN update specs for the first phase of a sparse
+    migration: the content, and the migrating widgets and modules.
+
+    Args:
+        widgetSpecs - List of (widget directory name, module directory name)
+            tuples.
+    """
+    specs = [
+        {
+            'path': './',
+            'depth': 'immediates'
+        },
+        {
+            'path': './s9ml',
+            'depth': 'infinity'
+        }
+    ]
+    for widgetDir, moduleDir in widgetSpecs:
+        specs.append({
+            'path': './assets/widgets/' + widgetDir,
+            'depth': 'infinity'
+        })
+        specs.append({
+            'path': './' + svn.PROJECT_MODULE_DIR + '/' + moduleDir,
+            'depth': 'infinity'
+        })
+    return specs
+
+def _toUnicode(path):
+    if isinstance(path, str):
+        return path.decode(sys.getfilesystemencoding() or 'utf8')
+    return path
+
+
+def _iterHTMLFiles(rootDir):
+    """Yields the absolute path of each HTML file under the root directory as
+    it is found.
 
     Args:
         rootDir - String absolute path of the directory tree to search.
     """
-    htmlFiles = []
-    for root, dirs, files in os.walk(rootDir):
-        for filename in [f for f in files if f.endswith('.html')]:
-            htmlFiles.append(os.path.join(root, filename))
-    return htmlFiles
+    if scandir is None:
+        for root, dirs, files in os.walk(rootDir):
+            if '.svn' in dirs:
+                dirs.remove('.svn')
+            for filename in [f for f in files if f.endswith('.html')]:
+                yield os.path.join(root, filename)
+        return
+
+    if not os.path.isdir(rootDir):
+        return
+
+    directories = [rootDir]
+    while directories:
+        for entry in scandir(directories.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != '.svn':
+                    directories.append(entry.path)
+            elif entry.name.endswith('.html'):
+                yield entry.path
+
+# State shared by the HTML migration workers of a project, set once in each
+# worker process by _initWorker.
+_workerState = {}
+
+def _getWorkerPids(pool):
+    # Pool has no public list of its processes.
+    return set(worker.pid for worker in pool._pool)
+
+def _initWorker(migrations, pathIndex, streaming):
+    _workerState['migrations'] = migrations
+    _workerState['pathIndex'] = pathIndex
+    _workerState['streaming'] = streaming
+
+def _migrateHTMLFile(filePath):
+    """Migrates a single content file using the worker's migrations.
+
+    Returns:
+        A dict with the following properties:
+            filePath - String absolute path to the file.
+            skipped - Whether the file can't reference the widgets, so wasn't
+                parsed.
+            updated - Whether the file was rewritten.
+            configUpdates - List of (configPath, widgetAbsolutePath,
+                modularWidgetAbsolutePath) tuples for the config files of the
+                file's migrated widgets.
+            error - String error message if the file couldn't be updated,
+                otherwise None.
+    """
+    migrations = _workerState['migrations']
+    result = {
+        'filePath': filePath,
+        'skipped': False,
+        'updated': False,
+        'configUpdates': [],
+        'error': None
+    }
+    try:
+        if _mayReferenceWidgets(filePath,
+                [migration[0] for migration in migrations]):
+            result['updated'], result['configUpdates'] = _updateHTMLFile(
+                filePath, migrations, _workerState['pathIndex'],
+                _workerState['streaming'])
+        else:
+            result['skipped'] = True
+    except Exception as e:
+        # Any error must make it back to the parent process so the project
+        # isn't committed.
+        result['error'] = 'Unable to update %s: %s' % (filePath, e)
+    return result
+
+def _migrateHTMLFiles(rootDir, migrations, pathIndex, jobs, streaming=False):
+    """Migrates all content files under the root directory.
 
-def _updateHTMLFile(filePath, widgetAbsolutePath, modularWidgetAbsolutePath):
-    """Updates file and linked widget JSON config files.
+    Files are parsed and updated by a pool of worker processes as they're
+    found. Config files referenced by the migrated widgets aren't updated, but
+    returned to be updated once each by _updateConfigFiles.
 
-    Updates the specified HTML file changing all references to the
-    non-modular widget to instead reference the modular widget, and all paths
+    Args:
+        rootDir - String absolute path of the directory tree to migrate.
+        migrations - List of (widgetAbsolutePath, modularWidgetAbsolutePath)
+            tuples, as for _updateHTMLFile.
+        pathIndex - PathIndex of the project repo.
+        jobs - Number of worker processes. With 1, files are migrated in this
+            process.
+        streaming - Whether to stream files rather than parse them, as for
+            _updateHTMLFile.
+
+    Returns:
+        A tuple of the number of files skipped, the total number of HTML
+        files, a list of the paths of the files rewritten, a dict from config
+        file path to the list of (widgetAbsolutePath,
+        modularWidgetAbsolutePath) tuples of the migrated widgets using it,
+        and a list of String error messages.
+    """
+    results = []
+    errors = []
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _initWorker,
+            (migrations, pathIndex, streaming))
+        # A worker that dies, e.g. killed for using too much memory, is
+        # replaced but the files it was migrating never return a result.
+        # Noticing the replacement stops the wait for them.
+        workerPids = _getWorkerPids(pool)
+        finished = False
+        try:
+            # One file per task, as results of larger chunks can't be waited
+            # on with a timeout.
+            fileResults = pool.imap_unordered(_migrateHTMLFile,
+                _iterHTMLFiles(rootDir))
+            while True:
+                try:
+                    results.append(fileResults.next(WORKER_CHECK_INTERVAL))
+                except StopIteration:
+                    finished = True
+                    break
+                except multiprocessing.TimeoutError:
+                    if _getWorkerPids(pool) != workerPids:
+                        errors.append('A worker process exited while '
+                            'migrating content files in %s' % rootDir)
+                        break
+                except Exception as e:
+                    errors.append('Unable to migrate content files in %s: %s'
+                        % (rootDir, e))
+                    break
+        finally:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+    else:
+        _initWorker(migrations, pathIndex, streaming)
+        for filePath in _iterHTMLFiles(rootDir):
+            results.append(_migrateHTMLFile(filePath))
+
+    results.sort(key=lambda result: result['filePath'])
+    errors.extend(result['error'] for result in results if result['error'])
+
+    # Several files often embed the same widget config. Update each config
+    # once, for all the migrated widgets referencing it.
+    configUpdates = collections.OrderedDict()
+    for result in results:
+        for configPath, widgetPath, modularWidgetPath in result['configUpdates']:
+            widgetPaths = configUpdates.setdefault(configPath, [])
+            if (widgetPath, modularWidgetPath) not in widgetPaths:
+                widgetPaths.append((widgetPath, modularWidgetPath))
+
+    skipped = len([result for result in results if result['skipped']])
+    updatedFiles = [result['filePath'] for result in results
+        if result['updated']]
+    return skipped, len(results), updatedFiles, configUpdates, errors
+
+def _updateConfigFiles(configUpdates, pathIndex):
+    """Updates each config file for the migrated widgets using it.
+
+    Args:
+        configUpdates - Dict from config file path to a list of
+            (widgetAbsolutePath, modularWidgetAbsolutePath) tuples, as
+            returned by _migrateHTMLFiles.
+        pathIndex - PathIndex of the project repo.
+
+    Returns:
+        A tuple of a list of the paths of the config files rewritten, and a
+        list of String error messages.
+    """
+    updatedFiles = []
+    errors = []
+    for configPath, widgetPaths in configUpdates.items():
+        try:
+            if _updateConfigFile(configPath, widgetPaths, pathIndex):
+                updatedFiles.append(configPath)
+        except (IOError, ValueError) as e:
+            errors.append('Unable to update %s: %s' % (configPath, e))
+    return updatedFiles, errors
+
+def _mayReferenceWidgets(filePath, widgetPaths):
+    """Returns whether the file's bytes contain the relative path to the view
+    page of any of the widgets. Files that don't can't reference the widgets,
+    so they needn't be decoded or parsed.
+
+    Args:
+        filePath - String absolute path to the file to check.
+        widgetPaths - List of String absolute paths to non-modular widgets.
+    """
+    needles = [os.path.join(
+            os.path.relpath(widgetPath, os.path.dirname(filePath)),
+            'index.html').encode('utf8')
+        for widgetPath in widgetPaths]
+
+    size = os.path.getsize(filePath)
+    if size == 0:
+        return False
+
+    with open(filePath, 'rb') as htmlFile:
+        if size < MMAP_THRESHOLD:
+            content = htmlFile.read()
+            return any(needle in content for needle in needles)
+
+        content = mmap.mmap(htmlFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return any(content.find(needle) != -1 for needle in needles)
+        finally:
+            content.close()
+
+def _updateHTMLFile(filePath, migrations, pathIndex, streaming=False):
+    """Updates file and finds linked widget JSON config files.
+
+    Updates the specified HTML file changing all references to each
+    non-modular widget to instead reference its modular widget, and all paths
     relative to the non-modular widget to be relative to the modular widget.
-    Also fixes any JSON configuration files references from a widget's <object>
-    tag.
+    Also finds any JSON configuration files referenced from a widget's <object>
+    tag. The file is read, parsed and written once for all migrations.
 
     Args:
         filePath - String absolute path to the file to update.
-        widgetAbsolutePath - String absolute path to the non-modular widget.
-        modularWidgetAbsolutePath - String absolute path to the modular widget.
+        migrations - List of (widgetAbsolutePath, modularWidgetAbsolutePath)
+            tuples of String absolute paths to each non-modular widget and the
+            modular widget replacing it.
+        pathIndex - PathIndex of the project repo, used to check whether param
+            values are paths.
+        streaming - Whether to scan the file in chunks and rewrite it through
+            a temporary file, rather than reading it whole. Memory use then
+            depends on the longest tag, comment or script in the file rather
+            than on its size.
+
+    Returns:
+        A tuple of whether the file was written, and a list of (configPath,
+        widgetAbsolutePath, modularWidgetAbsolutePath) tuples for the config
+        files that need updating. They aren't updated here so that a config
+        used by several files is only updated once.
     """
+    # Source offsets of every <object> data attribute and <param> value. All
+    # changes are spliced in at these offsets in one pass, so only the
+    # attribute values themselves change. The file isn't parsed into a
+    # document as well: the params to update are the ones the scan found.
     log.debug('Reading HTML file: %s', filePath)
-    with codecs.open(filePath, 'rb', encoding='utf8') as htmlFile:
-        htmlContent = ''.join(htmlFile.readlines())
-
-    soup = BeautifulSoup(htmlContent)
-
-    # Non-modular Widget view page path relative to the content. This path
-    # will be the data attribute of any widget object tags.
-    widgetViewRelativePath = os.path.join(
-        os.path.relpath(widgetAbsolutePath, os.path.dirname(filePath)),
-        'index.html')
-
-    # Absolute path to the modular version of the widget view page.
-    absModuleViewPath = os.path.join(
-        modularWidgetAbsolutePath, 'index.html')
-    # Widget view page path relative to the content.
-    relativeModuleViewPath = os.path.relpath(
-        absModuleViewPath, os.path.dirname(filePath))
-
-    # Convert all object data (iframe src) links to new modular location.
-    # This migrates all the widgets to point to their modular versions, but
-    # leaves all parameters and JSON config files incorrectly relative to
-    # the wrong location.
-    toReplace = r'(<object\s.*?data=")' + widgetViewRelativePath +'"'
-    replacement = r'\g<1>' + relativeModuleViewPath + '"'
-    htmlContent = re.sub(toReplace,
-                         replacement,
-                         htmlContent,
-                         flags=re.IGNORECASE)
-
-    # For all object tags, clean up params and including config file. Use
-    # the old relative path because BeautifulSoup parse tree was created
-    # before the regex replace above and doesn't know about it.
-    for object in soup.find_all('object',
-            attrs={'data': widgetViewRelativePath}):
-        # Find all param tags for that widget
-        for param in object.find_all('param'):
+    if streaming:
+        objects = _streamObjects(filePath)
+    else:
+        with codecs.open(filePath, 'rb', encoding='utf8') as htmlFile:
+            htmlContent = htmlFile.read()
+        objects = _scanObjects(htmlContent)
+    edits = {}
+    configUpdates = []
+
+    for widgetAbsolutePath, modularWidgetAbsolutePath in migrations:
+        # Non-modular Widget view page path relative to the content. This path
+        # will be the data attribute of any widget object tags.
+        widgetViewRelativePath = os.path.join(
+            os.path.relpath(widgetAbsolutePath, os.path.dirname(filePath)),
+            'index.html')
+
+        # Absolute path to the modular version of the widget view page.
+        absModuleViewPath = os.path.join(
+            modularWidgetAbsolutePath, 'index.html')
+        # Widget view page path relative to the content.
+        relativeModuleViewPath = os.path.relpath(
+            absModuleViewPath, os.path.dirname(filePath))
+
+        # For all object tags, clean up params and including config file. Map
+        # each param value that is a path relative to the non-modular widget
+        # to the same path relative to the modular widget.
+        params = [(param['name'], param['value']) for object in objects
+            if object['data'] == widgetViewRelativePath
+            for param in object['params']]
+
+        paramUpdates = {}
+        for name, val in params:
             # Param value could be anything, but it might be a relative
-            # path. Treat it as such creating an absolute path and see if it
-            # exists. If it does, assume it is a relative path to something
-            # in the project and update it to be relative to the new modular
-            # widget location.
-            val = param.get('value')
+            # path. Treat it as such creating an absolute path and see if
+            # it exists. If it does, assume it is a relative path to
+            # something in the project and update it to be relative to the
+            # new modular widget location.
 
             # Don't replace empty string "" with path relative to widget.
             if not val:
@@ -180,75 +605,295 @@ def _updateHTMLFile(filePath, widgetAbsolutePath, modularWidgetAbsolutePath):
 
             # NOTE(andy): For this test to work we have to check out the
             # whole book. Sad times. But now we do.
-            if os.path.exists(path):
-                newPath = os.path.relpath(path, modularWidgetAbsolutePath)
-
-                # Target specifically the parameter with a relative path
-                # inside the <object> tag we are migrating. If we didn't
-                # include the <object> tag we could accidentally change
-                # a relative path for a widget that wasn't migrating that
-                # referenced the same asset / content.
-                toReplace = (r'(<object.*?data="' + relativeModuleViewPath +
-                    '".*?<param.*?value=")' + val + '(".*?)(?=</object>)')
-                replacement = r'\g<1>' + newPath + r'\g<2>'
-                htmlContent = re.sub(toReplace,
-                                     replacement,
-                                     htmlContent,
-                                     flags=re.IGNORECASE|re.DOTALL)
-
-                # If the param is for the widget config file, also clean up
-                # that config file.
-                if param.get('name') == 'configFile':
-                    _updateConfigFile(path, widgetAbsolutePath,
-                                      modularWidgetAbsolutePath)
+            if pathIndex.exists(path):
+                paramUpdates[val] = os.path.relpath(path,
+                    modularWidgetAbsolutePath)
+
+                # If the param is for the widget config file, also clean
+                # up that config file.
+                if name == 'configFile':
+                    configUpdates.append((path, widgetAbsolutePath,
+                                          modularWidgetAbsolutePath))
+
+        # Convert all object data (iframe src) links to new modular location,
+        # and params of those objects to be relative to it. Only params inside
+        # the <object> tags we are migrating change, so a widget that isn't
+        # migrating but references the same asset / content is left alone.
+        for object in objects:
+            if object['data'] != widgetViewRelativePath:
+                continue
+            edits[object['dataSpan']] = escape(relativeModuleViewPath, True)
+            for param in object['params']:
+                if param['value'] in paramUpdates:
+                    edits[param['valueSpan']] = escape(
+                        paramUpdates[param['value']], True)
+
+    if not edits:
+        log.debug('No widget references to update in HTML file: %s', filePath)
+        return False, configUpdates
 
     # Write out all the changes.
     log.info('Writing updated HTML file: %s', filePath)
-    with codecs.open(filePath, 'wb', encoding='utf8') as htmlFile:
-        htmlFile.write(htmlContent)
+    if streaming:
+        _streamEdits(filePath, edits)
+    else:
+        with codecs.open(filePath, 'wb', encoding='utf8') as htmlFile:
+            htmlFile.write(_applyEdits(htmlContent, edits))
+
+    return True, configUpdates
+
+def _scanObjects(htmlContent):
+    """Returns every <object> element in the content with the source offsets
+    of its data attribute and of its <param> values, found in one scan.
+    Objects in comments and in <script> and <style> elements are skipped, as
+    an HTML parser would.
+
+    Returns:
+        A list of dicts with the following properties:
+            data - The object's data attribute, or None.
+            dataSpan - (start, end) offsets of the data attribute value.
+            params - List of dicts with name, value and valueSpan properties
+                for each <param> with a value inside the object.
+    """
+    objects = []
+    currentObject = None
+    for match in OBJECT_TAG_PATTERN.finditer(htmlContent):
+        tagName = match.group(2)
+        if tagName is None:
+            if match.group(0).startswith('</'):
+                # </object>
+                currentObject = None
+            continue
 
-def _updateConfigFile(filePath, widgetPath, modularWidgetPath):
+        attributes = _getAttributeSpans(match.group(0), match.start())
+        if tagName.lower() == 'object':
+            data, dataSpan = attributes.get('data', (None, None))
+            currentObject = {
+                'data': data,
+                'dataSpan': dataSpan,
+                'params': []
+            }
+            objects.append(currentObject)
+        elif currentObject is not None and 'value' in attributes:
+            value, valueSpan = attributes['value']
+            currentObject['params'].append({
+                'name': attributes.get('name', (None, None))[0],
+                'value': value,
+                'valueSpan': valueSpan
+            })
+    return objects
+
+class _ObjectTagParser(HTMLParser):
+    """Collects <object> elements and their <param> values with their source
+    offsets from HTMLParser events, without building a document.
+
+    Only the start of each line not yet passed by the parser is kept to turn
+    HTMLParser positions into offsets. HTMLParser itself keeps any markup it
+    can't finish yet, such as an open comment or script, so memory use depends
+    on the longest of those and the chunks fed to it, not on the file size.
+
+    Attributes:
+        objects - List of object dicts, as returned by _scanObjects.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.objects = []
+        self._currentObject = None
+        self._fedLength = 0
+        # (line number, offset) of the start of each line the parser may
+        # still report a position on.
+        self._lineStarts = collections.deque([(1, 0)])
+
+    def feed(self, data):
+        lineNumber = self._lineStarts[-1][0]
+        index = data.find('\n')
+        while index != -1:
+            lineNumber += 1
+            self._lineStarts.append((lineNumber, self._fedLength + index + 1))
+            index = data.find('\n', index + 1)
+        self._fedLength += len(data)
+        HTMLParser.feed(self, data)
+        # Everything before the parser's position has been handled.
+        self._dropLinesBefore(self.getpos()[0])
+
+    def handle_starttag(self, tag, attrs):
+        # Positions only move forward, so lines before this tag are done with.
+        lineNumber, column = self.getpos()
+        self._dropLinesBefore(lineNumber)
+
+        if tag not in ('object', 'param'):
+            return
+
+        attributes = _getAttributeSpans(self.get_starttag_text(),
+            self._lineStarts[0][1] + column)
+        if tag == 'object':
+            data, dataSpan = attributes.get('data', (None, None))
+            self._currentObject = {
+                'data': data,
+                'dataSpan': dataSpan,
+                'params': []
+            }
+            self.objects.append(self._currentObject)
+        elif self._currentObject is not None and 'value' in attributes:
+            value, valueSpan = attributes['value']
+            self._currentObject['params'].append({
+                'name': attributes.get('name', (None, None))[0],
+                'value': value,
+                'valueSpan': valueSpan
+            })
+
+    def handle_endtag(self, tag):
+        if tag == 'object':
+            self._currentObject = None
+
+    def _dropLinesBefore(self, lineNumber):
+        while (len(self._lineStarts) > 1 and
+                self._lineStarts[1][0] <= lineNumber):
+            self._lineStarts.popleft()
+
+def _streamObjects(filePath):
+    """Returns every <object> element in the file, as for _scanObjects, reading
+    the file in chunks.
+    """
+    parser = _ObjectTagParser()
+    with codecs.open(filePath, 'rb', encoding='utf8') as htmlFile:
+        for chunk in iter(lambda: htmlFile.read(STREAMING_CHUNK_SIZE), ''):
+            parser.feed(chunk)
+    parser.close()
+    return parser.objects
+
+def _streamEdits(filePath, edits):
+    """Rewrites the file with each (start, end) span in edits replaced by its
+    value. The file is copied in chunks to a temporary file which then
+    replaces it.
+    """
+    edits = sorted(edits.items())
+    temporaryPath = filePath + '.migrating'
+    try:
+        _copyWithEdits(filePath, temporaryPath, edits)
+        shutil.copymode(filePath, temporaryPath)
+        os.rename(temporaryPath, filePath)
+    except:
+        # Don't leave the partial copy in the content to be committed.
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+        raise
+
+def _copyWithEdits(filePath, temporaryPath, edits):
+    """Copies the file to temporaryPath in chunks, with the sorted edits
+    applied.
+    """
+    with codecs.open(filePath, 'rb', encoding='utf8') as source:
+        with codecs.open(temporaryPath, 'wb', encoding='utf8') as destination:
+            editIndex = 0
+            chunkStart = 0
+            # Offset up to which the source has been copied or replaced.
+            position = 0
+            for chunk in iter(lambda: source.read(STREAMING_CHUNK_SIZE), ''):
+                chunkEnd = chunkStart + len(chunk)
+                while (editIndex < len(edits) and
+                        edits[editIndex][0][0] < chunkEnd):
+                    (start, end), replacement = edits[editIndex]
+                    destination.write(chunk[max(position - chunkStart, 0):
+                        start - chunkStart])
+                    destination.write(replacement)
+                    position = end
+                    editIndex += 1
+                destination.write(chunk[max(position - chunkStart, 0):])
+                chunkStart = chunkEnd
+
+def _getAttributeSpans(tagText, offset):
+    """Returns a dict from lower case attribute name to a tuple of the
+    attribute value, with character references decoded, and the (start, end)
+    offsets of its source text, for the attributes with values in a start tag
+    found at offset.
+    """
+    attributes = {}
+    for match in ATTRIBUTE_PATTERN.finditer(tagText):
+        group = next(group for group in (2, 3, 4)
+            if match.group(group) is not None)
+        attributes.setdefault(match.group(1).lower(),
+            (unescape(match.group(group)),
+            (offset + match.start(group), offset + match.end(group))))
+    return attributes
+
+def _applyEdits(content, edits):
+    """Returns content with each (start, end) span in edits replaced by its
+    value, spliced together in a single pass.
+    """
+    pieces = []
+    position = 0
+    for (start, end), replacement in sorted(edits.items()):
+        pieces.append(content[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(content[position:])
+    return ''.join(pieces)
+
+def _updateConfigFile(filePath, widgetPaths, pathIndex):
     """Updates all values nested in the JSON object that are paths relative to
-    the widgetPath to instead be relative to modularWidgetPath.
+    a migrated widget to instead be relative to its modular widget.
+
+    All replacements are made in one pass over the file, which is written once.
 
         Args:
             filePath - String absolute path to the JSON config file.
-            widgetPath - String absolute path to the non-modular widget.
-            modularWidthPath - String absolute path to the modular widget.
+            widgetPaths - List of (widgetPath, modularWidgetPath) tuples of
+                String absolute paths to each non-modular widget referencing
+                the config file and its modular widget.
+            pathIndex - PathIndex of the project repo.
+
+        Returns:
+            Whether the file was rewritten.
     """
     log.debug('Reading JSON config file: %s', filePath)
     with codecs.open(filePath, 'rb', encoding='utf8') as configFile:
-        jsonContent = ''.join(configFile.readlines())
+        jsonContent = configFile.read()
 
     data = json.loads(jsonContent)
 
     # Create a map of all Strings in the JSON that need migration. The key is
     # the non-modular relative path and the value is the modular relative path.
-    if isinstance(data, dict):
-        replacementMap = _getStringReplacementsInDict(data, widgetPath,
-                modularWidgetPath)
-    if isinstance(data, list):
-        replacementMap = _getStringReplacementsInList(data,
-                widgetPath, modularWidgetPath)
-
-    # For each entry in the map, replace.
-    for key, value in replacementMap.iteritems():
-            # Negative lookbehind for a '\' ensures we are only matching
-            # complete JSON strings and not quoted entities inside strings. For
-            # example if the relative path was '../foo' we would match
-            # {"bar": "../foo"} but we would not match
-            # {"baz": "confusing value \"../foo"} or
-            # {"baz": "confusing value \"../foo\""}
-            # JSON Strings must be double quoted.
-            jsonContent = re.sub(r'(?<!\\)"' + key + '"',
-                                 '"' + value + '"',
-                                 jsonContent)
+    replacementMap = {}
+    for widgetPath, modularWidgetPath in widgetPaths:
+        if isinstance(data, dict):
+            replacements = _getStringReplacementsInDict(data, widgetPath,
+                    modularWidgetPath, pathIndex)
+        elif isinstance(data, list):
+            replacements = _getStringReplacementsInList(data,
+                    widgetPath, modularWidgetPath, pathIndex)
+        else:
+            replacements = {}
+
+        for key, value in replacements.iteritems():
+            if replacementMap.setdefault(key, value) != value:
+                log.warning('"%s" in %s is relative to more than one migrated '
+                    'widget, updating it relative to the first.', key,
+                    filePath)
+
+    if not replacementMap:
+        log.debug('No paths to update in JSON config file: %s', filePath)
+        return False
+
+    # Negative lookbehind for a '\' ensures we are only matching complete
+    # JSON strings and not quoted entities inside strings. For example if the
+    # relative path was '../foo' we would match {"bar": "../foo"} but we would
+    # not match {"baz": "confusing value \"../foo"} or
+    # {"baz": "confusing value \"../foo\""}
+    # JSON Strings must be double quoted.
+    pattern = re.compile(r'(?<!\\)"(' + '|'.join(re.escape(key)
+        for key in sorted(replacementMap, key=len, reverse=True)) + ')"')
+    jsonContent = pattern.sub(
+        lambda match: '"' + replacementMap[match.group(1)] + '"', jsonContent)
 
     log.info('Writing updated JSON config file: %s', filePath)
     with codecs.open(filePath, 'wb', encoding='utf8') as configFile:
         configFile.write(jsonContent)
+    return True
 
-def _getStringReplacementsInDict(data, widgetPath, modularWidgetPath):
+def _getStringReplacementsInDict(data, widgetPath, modularWidgetPath,
+        pathIndex):
     """Returns a map of all string relative paths in dictionary that need
     updating.
 
@@ -256,44 +901,49 @@ def _getStringReplacementsInDict(data, widgetPath, modularWidgetPath):
         data - The dictionary to search
         widgetPath - The absolute path to the non-modular widget.
         modularWidgetPath - The absolute path to the modular widget.
+        pathIndex - PathIndex of the project repo.
     """
     replacementMap = {}
     for key, value in data.iteritems():
         if isinstance(value, basestring):
-            newValue = _getUpdatedString(value, widgetPath, modularWidgetPath)
+            newValue = _getUpdatedString(value, widgetPath,
+                modularWidgetPath, pathIndex)
             if newValue != value:
                 replacementMap[value] = newValue
         elif isinstance(value, dict):
             replacementMap.update(_getStringReplacementsInDict(value,
-                widgetPath, modularWidgetPath))
+                widgetPath, modularWidgetPath, pathIndex))
         elif isinstance(value, list):
             replacementMap.update(_getStringReplacementsInList(value,
-                widgetPath, modularWidgetPath))
+                widgetPath, modularWidgetPath, pathIndex))
     return replacementMap
 
-def _getStringReplacementsInList(data, widgetPath, modularWidgetPath):
+def _getStringReplacementsInList(data, widgetPath, modularWidgetPath,
+        pathIndex):
     """Returns a map of all string relative paths in list that need updating.
 
     Args:
         data - The list to search
         widgetPath - The absolute path to the non-modular widget.
         modularWidgetPath - The absolute path to the modular widget.
+        pathIndex - PathIndex of the project repo.
     """
     replacementMap = {}
     for item in data:
         if isinstance(item, basestring):
-            newValue = _getUpdatedString(item, widgetPath, modularWidgetPath)
+            newValue = _getUpdatedString(item, widgetPath,
+                modularWidgetPath, pathIndex)
             if newValue != item:
                 replacementMap[item] = newValue
         elif isinstance(item, dict):
             replacementMap.update(_getStringReplacementsInDict(item,
-                widgetPath, modularWidgetPath))
+                widgetPath, modularWidgetPath, pathIndex))
         elif isinstance(item, list):
             replacementMap.update(_getStringReplacementsInList(item,
-                widgetPath, modularWidgetPath))
+                widgetPath, modularWidgetPath, pathIndex))
     return replacementMap
 
-def _getUpdatedString(value, widgetPath, modularWidgetPath):
+def _getUpdatedString(value, widgetPath, modularWidgetPath, pathIndex):
     """Returns updated version of the string.
 
     If the string is not a valid relative path from widgetPath returns the
@@ -304,84 +954,152 @@ def _getUpdatedString(value, widgetPath, modularWidgetPath):
         value - The string to check.
         widgetPath - The absolute path to the non-modular widget.
         modularWidgetPath - The absolute path to the modular widget.
+        pathIndex - PathIndex of the project repo.
     """
     if not value:
         return value
 
     absPath = os.path.normpath(os.path.join(widgetPath, value))
-    if os.path.exists(absPath):
+    if pathIndex.exists(absPath):
         newPath = os.path.relpath(absPath, modularWidgetPath)
         return newPath
     return value
 
-def _deleteNonModularWidgetPatterns(repoPath, widgetDir):
-    """Deletes all patterns referencing the specified widget.
+class PatternFile(object):
+    """A pattern snippets file, parsed once into a block per pattern and
+    indexed by the widgets each pattern references.
+
+    Attributes:
+        content - String content of the file.
+        blocks - List of dicts for each pattern with the following properties:
+            start - Offset of the start of the pattern, including any
+                whitespace before its comment.
+            end - Offset of the end of the closing </script> tag.
+            comment - The comment naming the pattern, or None.
+            script - The opening <script> tag.
+            body - The script body, the pattern's HTML.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.blocks = []
+        # Object data paths to the blocks referencing them.
+        self._blocksByWidget = {}
+        for match in PATTERN_BLOCK_PATTERN.finditer(content):
+            block = {
+                'start': match.start(),
+                'end': match.end(),
+                'comment': match.group(2),
+                'script': match.group(3),
+                'body': match.group(4)
+            }
+            self.blocks.append(block)
+            # The script body isn't parsed as HTML as part of the file, so
+            # scan it separately for the widgets it embeds.
+            for object in _scanObjects(block['body']):
+                if object['data'] is not None:
+                    self._blocksByWidget.setdefault(object['data'],
+                        []).append(block)
+
+    def getBlocks(self, widgetViewPaths):
+        """Returns the blocks referencing any of the widget view pages, in file
+        order.
+        """
+        blocks = {}
+        for widgetViewPath in widgetViewPaths:
+            for block in self._blocksByWidget.get(widgetViewPath, []):
+                blocks[block['start']] = block
+        return [blocks[start] for start in sorted(blocks)]
+
+    def getContentWithout(self, blocks):
+        """Returns the file content with the blocks removed.
+        """
+        content = _applyEdits(self.content, dict(
+            ((block['start'], block['end']), '') for block in blocks))
+        # Removing the first pattern leaves the whitespace that separated it
+        # from the next one at the top of the file.
+        if any(block['start'] == 0 for block in blocks):
+            content = content.lstrip()
+        return content
+
+
+def _deleteNonModularWidgetPatterns(repoPath, widgetDirs):
+    """Deletes all patterns referencing any of the specified widgets.
+
+    The pattern file is read once and written once for all the widgets.
 
     Args:
         repoPath - String absolute path to the root of the project SVN repo.
-        widgetDir - String name of the widget directory (not path).
+        widgetDirs - List of String names of widget directories (not paths).
+
+    Returns:
+        The path of the pattern file if it was rewritten, otherwise None.
     """
     patternFilePath = os.path.join(repoPath, 's9ml', '.templates',
         'pattern-snippets.html.tpls')
     if os.path.exists(patternFilePath):
         log.debug('Reading pattern snippet file: %s', patternFilePath)
         with codecs.open(patternFilePath, 'rb', encoding='utf8') as patternFile:
-            patternContent = ''.join(patternFile.readlines())
-
-        soup = BeautifulSoup(patternContent)
+            patterns = PatternFile(patternFile.read())
 
         # All patterns written assuming the content is in
         # /s9ml/chapter/file.html
-        widgetViewRelativePath = os.path.join('..', '..', 'assets', 'widgets',
-            widgetDir, 'index.html')
-
-        # For each pattern, figure out if the pattern references the
-        # non-modular widget. If it does we want to delete it.
-        for script in  soup.find_all('script'):
-            # BeautifulSoup stops processing the file at the <script> tag
-            # because its contents might not be HTML. We must separately
-            # parse its content to find the object tags it contains that
-            # reference the widget.
-            innerSoup = BeautifulSoup(script.text)
-            widget = innerSoup.find('object',
-                attrs={'data': widgetViewRelativePath})
-            if widget is not None:
-                # Script tag's contents are exactly referenced by its text
-                # attribute. We can escape that for a regex that perfectly
-                # matches the pattern contents and just find the surrounding
-                # script tags and preceeding comment that names the pattern.
-                toRemove = (r'\n*<!--.*?-->(?:\s)*<script.*\n?' +
-                    re.escape(script.text) + r'(?:\s*)</script>')
-                patternContent = re.sub(
-                    toRemove,
-                    '',
-                    patternContent)
-
-        log.info('Writing updated pattern snippets file: %s', patternFilePath)
+        widgetViewRelativePaths = [os.path.join('..', '..', 'assets',
+            'widgets', widgetDir, 'index.html') for widgetDir in widgetDirs]
+
+        blocks = patterns.getBlocks(widgetViewRelativePaths)
+        if not blocks:
+            log.info('No patterns reference %s in %s', ', '.join(widgetDirs),
+                patternFilePath)
+            return None
+
+        for block in blocks:
+            log.debug('Deleting pattern: %s', (block['comment'] or
+                block['script']).strip())
+
+        log.info('Writing updated pattern snippets file without %d patterns: '
+            '%s', len(blocks), patternFilePath)
         with codecs.open(patternFilePath, 'wb', encoding='utf8') as patternFile:
-            patternFile.write(patternContent)
+            patternFile.write(patterns.getContentWithout(blocks))
+        return patternFilePath
     else:
         log.warning('No pattern file at "%s", not deleting patterns.',
             patternFilePath)
+        return None
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
-    # For each line of the CSV, after migrating the specified widget we commit
-    # the SVN repo. We skip the commit if there are errors during the migration.
-    # However, if another line of the CSV moves a different widget in the same
-    # project without errors we don't want to then commit both the successful
-    # and unsuccessful migrations. Track the repos with errors to prevent this.
-    # Some errors (unable to find widget or module) don't need to block commit.
-    # Dict value indicates if commit blocking error has happened.
+    # For each project in the CSV, after migrating the specified widgets we
+    # commit the SVN repo. We skip the commit if there are errors during the
+    # migration. However, if the same repo is listed again (e.g. by shortname
+    # and by path) and migrates without errors we don't want to then commit
+    # both the successful and unsuccessful migrations. Track the repos with
+    # errors to prevent this. Some errors (unable to find widget or module)
+    # don't need to block commit. Dict value indicates if commit blocking error
+    # has happened.
     reposWithErrors = {}
 
-    repoSpecs = _getSpecsFromCsv()
-    for name, environment, widgetDir, moduleDir in repoSpecs:
+    # Several rows often migrate widgets in the same project. Migrate all of a
+    # project's widgets together so each content file is read, parsed and
+    # written once, and the project is committed once.
+    session = svn.RepoSession()
+
+    projects = collections.OrderedDict()
+    for name, environment, widgetDir, moduleDir in _getSpecsFromCsv():
+        projects.setdefault((name, environment), []).append(
+            (widgetDir, moduleDir))
+
+    for (name, environment), widgetSpecs in projects.items():
+        if args.sparse:
+            updateSpecs = _getSparseSpecs(widgetSpecs)
+        else:
+            updateSpecs = svn.MODULE_MIGRATION_UPDATE_SPECS
+
         try:
-            repo = svn.ensureRepo(name, svn.MODULE_MIGRATION_UPDATE_SPECS,
-                environment=environment)
+            repo = svn.ensureRepo(name, updateSpecs,
+                environment=environment, session=session)
         except svn.SvnError as e:
             log.error(e.message + '\n')
             # Haven't done any migration, don't worry about skipping future
@@ -389,66 +1107,119 @@ if __name__ == '__main__':
             reposWithErrors[name + '-' + environment] = False
             continue
 
-        logging.info('Migrating from widget %s to module %s in %s-%s',
-                     widgetDir, moduleDir, name, environment)
+        # Absolute paths of each widget and module pair that can be migrated.
+        migrations = []
+        for widgetDir, moduleDir in widgetSpecs:
+            logging.info('Migrating from widget %s to module %s in %s-%s',
+                         widgetDir, moduleDir, name, environment)
+
+            widgetAbsolutePath = os.path.join(repo['path'], 'assets',
+                'widgets', widgetDir)
+            modularWidgetAbsolutePath = os.path.join(repo['path'], 'assets',
+                'modules', moduleDir, 'widgets', widgetDir)
+
+            if not os.path.isdir(widgetAbsolutePath):
+                log.error('Unable to find non-modular widget at: %s, unable to '
+                    'continue migration.\n',
+                    widgetAbsolutePath)
+                # Haven't done any migration, don't worry about skipping future
+                # commits.
+                reposWithErrors[repo['path']] = False
+                continue
 
-        widgetAbsolutePath = os.path.join(repo['path'], 'assets', 'widgets',
-            widgetDir)
-        modularWidgetAbsolutePath = os.path.join(repo['path'], 'assets',
-            'modules', moduleDir, 'widgets', widgetDir)
+            if not os.path.isdir(modularWidgetAbsolutePath):
+                log.error('Unable to find modular widget at: %s, unable to '
+                    'continue migration.\n',
+                    modularWidgetAbsolutePath)
+                # Haven't done any migration, don't worry about skipping future
+                # commits.
+                reposWithErrors[repo['path']] = False
+                continue
 
-        if not os.path.isdir(widgetAbsolutePath):
-            log.error('Unable to find non-modular widget at: %s, unable to '
-                'continue migration.\n',
-                widgetAbsolutePath)
-            # Haven't done any migration, don't worry about skipping future
-            # commits.
-            reposWithErrors[repo['path']] = False
+            migrations.append((widgetDir, moduleDir, widgetAbsolutePath,
+                modularWidgetAbsolutePath))
+
+        if not migrations:
             continue
 
-        if not os.path.isdir(modularWidgetAbsolutePath):
-            log.error('Unable to find modular widget at: %s, unable to '
-                'continue migration.\n',
-                modularWidgetAbsolutePath)
+        widgetDirs = [migration[0] for migration in migrations]
+        moduleDirs = [migration[1] for migration in migrations]
+
+        # Existence checks for paths in content and config files are answered
+        # from one walk of the project rather than a stat per value. A sparse
+        # working copy doesn't have most of the project, so the repository is
+        # listed instead.
+        try:
+            if args.sparse:
+                pathIndex = PathIndex(repo['path'],
+                    svn.listPaths(repo['state'].url))
+            else:
+                pathIndex = PathIndex(repo['path'])
+        except svn.SvnError as e:
+            log.error(e.message + '\n')
             # Haven't done any migration, don't worry about skipping future
             # commits.
             reposWithErrors[repo['path']] = False
             continue
 
-        # Find all html files that might have a widget to migrate.
-        htmlFiles = _getAllHTMLFiles(os.path.join(repo['path'], 's9ml'))
-
-        # For each html file, fix file contents and linked widget JSON config
-        # files.
-        try:
-            for filename in htmlFiles:
-                    _updateHTMLFile(filename, widgetAbsolutePath,
-                                    modularWidgetAbsolutePath)
-        except (IOError, ValueError) as e:
-            log.error(str(e))
+        # Fix all html file contents and linked widget JSON config files.
+        # Every path changed is collected so only they are committed.
+        skippedFiles, htmlFileCount, changedPaths, configUpdates, errors = \
+            _migrateHTMLFiles(os.path.join(repo['path'], 's9ml'),
+                [migration[2:] for migration in migrations], pathIndex,
+                args.jobs, args.streaming)
+
+        # The second phase of a sparse checkout. The config files of the
+        # migrated widgets are the only files referenced from the content that
+        # are rewritten, so only they are fetched. Other references only need
+        # to exist in the repository listing.
+        if args.sparse:
+            try:
+                svn.fetchPaths(list(configUpdates))
+            except svn.SvnError as e:
+                errors.append(e.message)
+
+        updatedConfigs, configErrors = _updateConfigFiles(configUpdates,
+            pathIndex)
+        changedPaths.extend(updatedConfigs)
+        errors.extend(configErrors)
+        if errors:
+            for error in errors:
+                log.error(error)
             log.error('Unable to update project content files, skipping rest '
-                      'of migration of %s to %s\n', widgetDir, moduleDir)
+                      'of migration of %s to %s\n', ', '.join(widgetDirs),
+                      ', '.join(moduleDirs))
             reposWithErrors[repo['path']] = True
             continue
+        log.info('Skipped %d of %d HTML files that don\'t reference %s',
+                 skippedFiles, htmlFileCount, ', '.join(widgetDirs))
 
-        # Delete patterns that reference the non-modular widget. Assuming that
-        # the modular widget includes the relevant patterns.
+        # Delete patterns that reference the non-modular widgets. Assuming that
+        # the modular widgets include the relevant patterns.
         try:
-            _deleteNonModularWidgetPatterns(repo['path'], widgetDir)
+            patternFilePath = _deleteNonModularWidgetPatterns(repo['path'],
+                widgetDirs)
+            if patternFilePath:
+                changedPaths.append(patternFilePath)
         except (IOError, ValueError) as e:
             log.error(e.strerror)
             log.error('Unable to update project pattern snippet file, skipping '
-                      'rest of migration of %s to %s\n', widgetDir, moduleDir)
+                      'rest of migration of %s to %s\n', ', '.join(widgetDirs),
+                      ', '.join(moduleDirs))
             reposWithErrors[repo['path']] = True
             continue
 
-        # Delete non-modular widget.
+        # Delete non-modular widgets.
         try:
-            svn.delete(widgetAbsolutePath)
+            for migration in migrations:
+                svn.delete(migration[2])
+                pathIndex.remove(migration[2])
+                changedPaths.append(migration[2])
         except svn.SvnError as e:
             log.error(e.message)
             log.error('Unable to delete non-modular widget, skipping rest of '
-                      'migration of %s to %s\n', widgetDir, moduleDir)
+                      'migration of %s to %s\n', ', '.join(widgetDirs),
+                      ', '.join(moduleDirs))
             reposWithErrors[repo['path']] = True
             continue
 
@@ -463,14 +1234,14 @@ if __name__ == '__main__':
                 'save changes.')
         else:
             try:
-                svn.cleanRepo(repo['path'])
-                svn.commit(repo['path'], 'Migrating from %s non-modular widget '
-                    'to modular widgets in %s using migrate.py' %(
-                        widgetDir, moduleDir))
+                svn.commit(repo['path'], 'Migrating from %s non-modular '
+                    'widgets to modular widgets in %s using migrate.py' %(
+                        ', '.join(widgetDirs), ', '.join(moduleDirs)),
+                    paths=changedPaths)
             except svn.SvnError as e:
                 log.error(e.message)
-                log.error('Unable to commit migration of %s to %s\n', widgetDir,
-                          moduleDir)
+                log.error('Unable to commit migration of %s to %s\n',
+                          ', '.join(widgetDirs), ', '.join(moduleDirs))
         print '\n'
 
     # Report results
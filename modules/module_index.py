@@ -0,0 +1,229 @@
+#
+# module_index.py
+# content-scripts
+#
+# For details and documentation:
+# http://github.com/inkling/content-scripts
+#
+# Copyright 2015 Inkling Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An on-disk index of the modules in a project working copy.
+
+The index is kept in the working copy's .svn directory and records each
+module's module.json along with a fingerprint of its content. An entry is
+reused as long as the module.json modification time and size are unchanged
+and the modules directory is at the same revision, so a warm lookup stats each
+module.json rather than reading and parsing it.
+
+The index also caches the hash of each file in a module, so the fingerprint of
+a whole module tree only reads files that changed since it was last computed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from s9logging import s9logging
+import svn.project_svn as svn
+
+s9logging.configureLogging()
+log = logging.getLogger(__name__)
+
+MODULE_CONFIG_FILE = 'module.json'
+
+# Index file, kept in the working copy's .svn directory.
+INDEX_FILE = 'module-index.json'
+
+
+def getModules(projectPath, revision=None):
+    """Returns a list of the project's modules' module.json as a dict, with an
+    extra 'systemPath' property added for module path.
+
+    Args:
+        projectPath - String absolute path to the project working copy.
+        revision - Revision of the project's modules directory. The index is
+            discarded when the revision changes. If None, only modification
+            times and sizes are compared.
+    """
+    moduleDir = os.path.join(projectPath, svn.PROJECT_MODULE_DIR)
+    if not os.path.isdir(moduleDir):
+        return []
+
+    indexPath = _getIndexPath(projectPath)
+    index = _readIndex(indexPath) if indexPath else {}
+    if index.get('revision') == revision:
+        entries = index.get('modules', {})
+    else:
+        entries = {}
+
+    modules = []
+    updatedEntries = {}
+    for module in sorted(os.listdir(moduleDir)):
+        jsonPath = os.path.join(moduleDir, module, MODULE_CONFIG_FILE)
+        try:
+            stat = os.stat(jsonPath)
+        except OSError:
+            continue
+
+        entry = entries.get(module)
+        if (entry is None or entry['mtime'] != stat.st_mtime or
+                entry['size'] != stat.st_size):
+            cachedFiles = entry.get('files') if entry else None
+            entry = _readModule(jsonPath, stat)
+            # File hashes are checked against their own mtime and size.
+            if cachedFiles:
+                entry['files'] = cachedFiles
+        updatedEntries[module] = entry
+
+        data = dict(entry['info'])
+        data['systemPath'] = os.path.join(moduleDir, module)
+        modules.append(data)
+
+    if indexPath and (updatedEntries != entries or
+            index.get('revision') != revision):
+        _writeIndex(indexPath, {
+            'revision': revision,
+            'modules': updatedEntries
+        })
+
+    return modules
+
+
+def getTreeFingerprint(projectPath, module, revision=None):
+    """Returns a fingerprint of a module's directory tree, a Merkle hash over
+    the names and contents of everything in it except .svn directories.
+
+    File hashes are cached in the project's index and reused while a file's
+    modification time and size are unchanged. Only modules already in the
+    index, i.e. returned by getModules, are cached.
+
+    Args:
+        projectPath - String absolute path to the project working copy.
+        module - String name of the module directory.
+        revision - Revision of the project's modules directory, as for
+            getModules.
+    """
+    indexPath = _getIndexPath(projectPath)
+    index = _readIndex(indexPath) if indexPath else {}
+    entry = None
+    if index.get('revision') == revision:
+        entry = index.get('modules', {}).get(module)
+
+    cachedFiles = entry.get('files', {}) if entry else {}
+    files = {}
+    fingerprint = _getTreeHash(
+        os.path.join(projectPath, svn.PROJECT_MODULE_DIR, module), '',
+        cachedFiles, files)
+
+    if entry is not None and files != cachedFiles:
+        entry['files'] = files
+        _writeIndex(indexPath, index)
+
+    return fingerprint
+
+
+def _getTreeHash(path, relativePath, cachedFiles, files):
+    """Returns the hash of the directory at path from the hashes of its
+    entries, adding the [mtime, size, hash] of each file under it to files.
+
+    Args:
+        path - String absolute path to the directory.
+        relativePath - String path of the directory relative to the tree root.
+        cachedFiles - Dict of previously computed files entries.
+        files - Dict from path relative to the tree root to file entry. Paths
+            are unicode, as they are when read back from the index.
+    """
+    entries = []
+    for name in sorted(os.listdir(path)):
+        if name == '.svn':
+            continue
+        childPath = os.path.join(path, name)
+        childRelativePath = os.path.join(relativePath, name)
+        if os.path.isdir(childPath) and not os.path.islink(childPath):
+            entries.append(b'tree ' + _toBytes(name) + b' ' + _toBytes(
+                _getTreeHash(childPath, childRelativePath, cachedFiles,
+                    files)))
+            continue
+
+        stat = os.lstat(childPath)
+        key = childRelativePath
+        if isinstance(key, bytes):
+            key = key.decode('utf8', 'replace')
+        cached = cachedFiles.get(key)
+        if (cached is not None and cached[0] == stat.st_mtime and
+                cached[1] == stat.st_size):
+            digest = cached[2]
+        elif os.path.islink(childPath):
+            digest = hashlib.sha1(_toBytes(os.readlink(childPath))).hexdigest()
+        else:
+            digest = _getFileHash(childPath)
+        files[key] = [stat.st_mtime, stat.st_size, digest]
+        entries.append(b'blob ' + _toBytes(name) + b' ' + _toBytes(digest))
+
+    return hashlib.sha1(b'\n'.join(entries)).hexdigest()
+
+
+def _getFileHash(path):
+    fileHash = hashlib.sha1()
+    with open(path, 'rb') as hashedFile:
+        for chunk in iter(lambda: hashedFile.read(1024 * 1024), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+def _toBytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf8')
+
+
+def _readModule(jsonPath, stat):
+    """Returns the index entry for a module.json file.
+    """
+    log.debug('Reading module config %s', jsonPath)
+    with open(jsonPath, 'rb') as jsonFile:
+        content = jsonFile.read()
+    return {
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'fingerprint': hashlib.sha1(content).hexdigest(),
+        'info': json.loads(content.decode('utf8'))
+    }
+
+
+def _getIndexPath(projectPath):
+    """Returns the path of the project's index, or None if the project isn't
+    a working copy root.
+    """
+    svnDir = os.path.join(projectPath, '.svn')
+    if not os.path.isdir(svnDir):
+        return None
+    return os.path.join(svnDir, INDEX_FILE)
+
+
+def _readIndex(indexPath):
+    try:
+        with open(indexPath) as indexFile:
+            return json.load(indexFile)
+    except (IOError, ValueError):
+        return {}
+
+
+def _writeIndex(indexPath, index):
+    # Write then rename so an interrupted run never leaves a partial index.
+    with open(indexPath + '.tmp', 'w') as indexFile:
+        json.dump(index, indexFile, indent=2, sort_keys=True)
+    os.rename(indexPath + '.tmp', indexPath)
@@ -0,0 +1,189 @@
+#
+# module_store.py
+# content-scripts
+#
+# For details and documentation:
+# http://github.com/inkling/content-scripts
+#
+# Copyright 2015 Inkling Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local content-addressed store of module versions.
+
+Each stored module is a copy of its directory tree without .svn directories,
+kept under <store>/<name>/<version>/<fingerprint>/. Modules are added as they
+are read from a source project, so a later sync of the same version can copy
+it from the store without touching the source project. Stored modules are
+synced into targets with hardlinks where the filesystem allows it, so stored
+files are made read-only to keep an edit in a target from changing the store.
+It is configured with an environment variable:
+
+    CONTENT_SCRIPTS_MODULE_STORE - Directory of the store. Defaults to
+        .module-store in the working copy cache directory.
+"""
+
+import json
+import logging
+import os
+import shutil
+import stat
+
+from s9logging import s9logging
+import svn.project_svn as svn
+from sync import tree_sync
+import module_index
+
+s9logging.configureLogging()
+log = logging.getLogger(__name__)
+
+STORE_DIR_VARIABLE = 'CONTENT_SCRIPTS_MODULE_STORE'
+DEFAULT_STORE_DIR = '.module-store'
+
+# Suffix of directories being written, renamed into place once complete.
+PARTIAL_SUFFIX = '.partial'
+
+
+class ModuleStore(object):
+    """A directory of module trees keyed by name, version and fingerprint.
+
+    Stored files are read-only, and targets synced from the store hardlink
+    them, so a target working copy's module files are the store's read-only
+    inodes: they can't be edited in place, and an svn update or revert of a
+    target replaces its links rather than writing through to the store.
+
+    Attributes:
+        directory - Absolute path of the store directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    @classmethod
+    def fromEnvironment(cls):
+        """Returns a ModuleStore configured by environment variables.
+        """
+        return cls(os.environ.get(STORE_DIR_VARIABLE, os.path.join(
+            svn.getWorkingCopies().directory, DEFAULT_STORE_DIR)))
+
+    def add(self, module, fingerprint):
+        """Copies a module into the store unless it is already there.
+
+        Args:
+            module - Module info dict, as returned by getModuleInfo.
+            fingerprint - String fingerprint of the module's directory tree.
+
+        Returns:
+            The path of the stored module directory, or None if the module's
+            name or version can't be used as a directory name.
+        """
+        entryPath = self._getEntryPath(module['name'], module['version'],
+            fingerprint)
+        if entryPath is None:
+            log.warning('Not storing module "%s" version %s, unsupported name '
+                'or version.', module['name'], module['version'])
+            return None
+
+        moduleDir = os.path.basename(module['systemPath'])
+        if os.path.isdir(entryPath):
+            return os.path.join(entryPath, moduleDir)
+
+        # Copy to a partial directory first so an interrupted run never leaves
+        # an incomplete entry.
+        partialPath = entryPath + PARTIAL_SUFFIX + str(os.getpid())
+        tree_sync.syncTree(tree_sync.TreeSnapshot(module['systemPath']),
+            os.path.join(partialPath, moduleDir))
+        _makeFilesReadOnly(partialPath)
+        try:
+            os.rename(partialPath, entryPath)
+        except OSError:
+            # Another run stored the same entry first.
+            shutil.rmtree(partialPath, ignore_errors=True)
+        log.debug('Stored module "%s" version %s at %s', module['name'],
+            module['version'], entryPath)
+        return os.path.join(entryPath, moduleDir)
+
+    def find(self, name, version):
+        """Returns the stored copies of a module version.
+
+        Args:
+            name - String module name.
+            version - String module version.
+
+        Returns:
+            A list of the module.json of each stored copy as a dict, with extra
+            'systemPath' and 'storePath' properties for the stored module
+            directory and a 'fingerprint' property for its fingerprint.
+        """
+        versionPath = self._getVersionPath(name, version)
+        if versionPath is None or not os.path.isdir(versionPath):
+            return []
+
+        modules = []
+        for fingerprint in sorted(os.listdir(versionPath)):
+            if PARTIAL_SUFFIX in fingerprint:
+                continue
+            entryPath = os.path.join(versionPath, fingerprint)
+            for moduleDir in os.listdir(entryPath):
+                modulePath = os.path.join(entryPath, moduleDir)
+                try:
+                    with open(os.path.join(modulePath,
+                            module_index.MODULE_CONFIG_FILE), 'rb') as jsonFile:
+                        data = json.loads(jsonFile.read().decode('utf8'))
+                except (IOError, ValueError):
+                    log.warning('Ignoring unreadable stored module at %s',
+                        modulePath)
+                    continue
+                data['systemPath'] = modulePath
+                data['storePath'] = modulePath
+                data['fingerprint'] = fingerprint
+                modules.append(data)
+        return modules
+
+    def _getVersionPath(self, name, version):
+        if not (_isSafeName(name) and _isSafeName(version)):
+            return None
+        return os.path.join(self.directory, _toNativeName(name),
+            _toNativeName(version))
+
+    def _getEntryPath(self, name, version, fingerprint):
+        versionPath = self._getVersionPath(name, version)
+        if versionPath is None:
+            return None
+        return os.path.join(versionPath, fingerprint)
+
+
+def _isSafeName(value):
+    """Returns whether value can be used as a single directory name.
+    """
+    return bool(value) and os.sep not in value and not value.startswith('.')
+
+
+def _toNativeName(name):
+    # Names read from module.json are unicode, but Python 2 paths are bytes.
+    if not isinstance(name, str):
+        return name.encode('utf8')
+    return name
+
+
+def _makeFilesReadOnly(path):
+    """Removes the write permissions of every file under path. Directories
+    stay writable so entries can still be replaced or removed.
+    """
+    for directoryPath, _, fileNames in os.walk(path):
+        for fileName in fileNames:
+            filePath = os.path.join(directoryPath, fileName)
+            if not os.path.islink(filePath):
+                mode = stat.S_IMODE(os.lstat(filePath).st_mode)
+                os.chmod(filePath, mode & ~(stat.S_IWUSR | stat.S_IWGRP |
+                    stat.S_IWOTH))
@@ -37,6 +37,13 @@ Example command lines:
         --modules com.inkling.samples.sample-patterns \
         com.inkling.samples.sample-widgets
     ./sync_modules -c <config file>
+    ./sync_modules -j 8 -c <config file>
+    ./sync_modules -c <config file>    # with modules given as name@version
+
+Modules read from a source project are added to the local module store. A
+module given as name@version that is already in the store is copied from there,
+and a row whose modules all come from the store doesn't check out or update its
+source project.
 """
 
 from __future__ import print_function
@@ -46,18 +53,20 @@ import csv
 import json
 import logging
 import os
-import subprocess
 import sys
 
 from distutils.version import StrictVersion
 
 import list_modules
+import module_store
 from s9logging import s9logging
 import svn.project_svn as svn
+from sync import tree_sync
 
 parser = argparse.ArgumentParser(description='Sync modules across Inkling '
     'projects')
-parser.add_argument('--modules', nargs='+', help='Names of modules to sync')
+parser.add_argument('--modules', nargs='+', help='Names of modules to sync, '
+    'each optionally pinned to a version as name@version')
 parser.add_argument('-s', '--source-repo', dest='source', help='Source project '
     'shortname or path')
 parser.add_argument('--repos', nargs='+', help='Destination project shortnames '
@@ -72,6 +81,8 @@ parser.add_argument('-c', '--config', help='CSV file specifying repos and '
     'destination-environment,module1,module2,..."')
 parser.add_argument('-n', '--dry-run', action='store_true', default=False,
     help='Dry run performing no sync or svn commit')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of '
+    'repos to check out or update concurrently')
 
 s9logging.configureLogging()
 log = logging.getLogger(__name__)
@@ -168,22 +179,160 @@ def _getModulesToSync(sourceInfo, targetInfo, moduleNames):
                     del modulesToSync[module['name']]
     return modulesToSync.values()
 
-def _syncModules(modulesToSync, target):
-    """Syncs all modules into the target repo.
+def _parseModuleSpecs(moduleSpecs):
+    """Returns a dict from module name to the version it is pinned to, or None
+    if it isn't pinned.
 
     Args:
-        modulesToSync - A list of module infos from source repo to sync to
-            target.
-        target - Target repo information
+        moduleSpecs - Iterable of module names, each optionally followed by
+            @version.
+    """
+    versions = {}
+    for spec in moduleSpecs:
+        name, _, version = spec.partition('@')
+        versions[name] = version or None
+    return versions
+
+def _getStoredModules(store, versions):
+    """Returns a dict from module name to the stored module info of each pinned
+    module version found in the store.
+
+    Args:
+        store - ModuleStore to look modules up in.
+        versions - Dict from module name to pinned version, as returned by
+            _parseModuleSpecs.
+    """
+    storedModules = {}
+    for name, version in versions.items():
+        if version is None:
+            continue
+        copies = store.find(name, version)
+        if len(copies) == 1:
+            storedModules[name] = copies[0]
+        elif len(copies) > 1:
+            log.warning('Module store has %s different copies of "%s" version '
+                '%s, reading it from the source project.', len(copies), name,
+                version)
+    return storedModules
+
+def _getPinnedModules(sourceInfo, versions, moduleNames):
+    """Returns the source modules, leaving out any pinned module whose source
+    version differs from its pinned version.
+
+    Args:
+        sourceInfo - Source repo module info object
+        versions - Dict from module name to pinned version, as returned by
+            _parseModuleSpecs.
+        moduleNames - Set of the names of the modules to sync. Modules left out
+            are removed from it, so they aren't reported again as missing from
+            the source.
+    """
+    modules = []
+    for module in sourceInfo:
+        pinnedVersion = versions.get(module['name'])
+        if pinnedVersion is not None and module['version'] != pinnedVersion:
+            log.error('Source has module "%s" at version %s rather than version '
+                '%s. Skipping sync\n', module['name'], module['version'],
+                pinnedVersion)
+            moduleNames.discard(module['name'])
+            continue
+        modules.append(module)
+    return modules
+
+def _storeModules(modulesToSync, source, store):
+    """Adds the modules to sync that were read from the source repo to the
+    module store, setting their 'fingerprint' and 'storePath' properties. On
+    a dry run only the fingerprints are set and the store isn't written.
+
+    Args:
+        modulesToSync - A list of module infos to sync to target.
+        source - Source repo information
+        store - ModuleStore to add modules to.
     """
     for module in modulesToSync:
-        targetPath = os.path.join(target['path'], svn.PROJECT_MODULE_DIR)
+        if 'storePath' in module:
+            continue
+        module['fingerprint'] = list_modules.getModuleFingerprint(
+            source['path'], os.path.basename(module['systemPath']),
+            source['state'])
         if args.dry_run:
-            print('\n"Move"', module['name'], 'v' + module['version'])
-        else:
-            subprocess.check_call(['rsync', '--delete',
-                '--recursive', module['systemPath'], targetPath])
-            print('\nMoved', module['name'], 'v' + module['version'])
+            continue
+        try:
+            storePath = store.add(module, module['fingerprint'])
+        except (IOError, OSError) as e:
+            log.warning('Unable to add module "%s" to the module store: %s',
+                module['name'], e)
+            continue
+        if storePath is not None:
+            module['storePath'] = storePath
+
+def _getChangedModules(modulesToSync, target):
+    """Returns the modules to sync that differ from the target's copy.
+
+    Modules whose directory tree has the same fingerprint in the source and
+    target repos are identical, so syncing them would change nothing.
+
+    Args:
+        modulesToSync - A list of module infos to sync to target, each with a
+            'fingerprint' property.
+        target - Target repo information
+    """
+    changedModules = []
+    for module in modulesToSync:
+        moduleDir = os.path.basename(module['systemPath'])
+        if os.path.isdir(os.path.join(target['path'], svn.PROJECT_MODULE_DIR,
+                moduleDir)):
+            targetFingerprint = list_modules.getModuleFingerprint(
+                target['path'], moduleDir, target['state'])
+            if module['fingerprint'] == targetFingerprint:
+                print('\nSkipping', module['name'], 'v' + module['version'],
+                    'which is identical in', target['path'])
+                continue
+        changedModules.append(module)
+    return changedModules
+
+def _syncModules(modulesToSync, target, snapshots):
+    """Syncs all modules into the target repo, writing only the files that
+    differ from the target's copy. Stored modules are hardlinked from the
+    module store where possible.
+
+    Args:
+        modulesToSync - A list of module infos to sync to target.
+        target - Target repo information
+        snapshots - Dict from source module path to its TreeSnapshot, shared
+            between targets so each source module is only listed once.
+            Snapshots of modules in the target repo are removed, as a later
+            row may sync from it.
+
+    Returns:
+        The TreeChanges made to the target repo.
+    """
+    changes = tree_sync.TreeChanges()
+    try:
+        for module in modulesToSync:
+            sourcePath = module.get('storePath', module['systemPath'])
+            if args.dry_run:
+                print('\n"Move"', module['name'], 'v' + module['version'])
+                continue
+
+            if sourcePath not in snapshots:
+                snapshots[sourcePath] = tree_sync.TreeSnapshot(sourcePath)
+            # Working copies don't keep the source's modification times, so
+            # compare content before rewriting a file.
+            moduleChanges = tree_sync.syncTree(snapshots[sourcePath],
+                os.path.join(target['path'], svn.PROJECT_MODULE_DIR,
+                    os.path.basename(sourcePath)),
+                link='storePath' in module, checksum=True)
+            changes.extend(moduleChanges)
+            print('\nMoved', module['name'], 'v' + module['version'], '(%d '
+                'paths changed)' % len(moduleChanges))
+    finally:
+        # The target's files are changing, so snapshots of it are stale.
+        targetPrefix = os.path.join(target['path'], '')
+        for sourcePath in [sourcePath for sourcePath in snapshots
+                if sourcePath.startswith(targetPrefix)]:
+            del snapshots[sourcePath]
+    return changes
 
 
 if __name__ == '__main__':
@@ -199,49 +348,93 @@ if __name__ == '__main__':
         syncSpecs = [(args.source, args.environment, repo, args.environment,
             set(args.modules)) for repo in args.repos]
 
-    for sourceName, sourceEnv, targetName, targetEnv, moduleNames in syncSpecs:
-        try:
-            source = svn.ensureRepo(sourceName, svn.MODULES_UPDATE_SPECS,
-                environment=sourceEnv)
-        except svn.SvnError as e:
-            log.error(e.message)
+    store = module_store.ModuleStore.fromEnvironment()
+    snapshots = {}
+
+    # Pinned module versions already in the store are copied from there, so
+    # rows that need nothing else don't check out or update their source.
+    rows = []
+    for sourceName, sourceEnv, targetName, targetEnv, moduleSpecs in syncSpecs:
+        versions = _parseModuleSpecs(moduleSpecs)
+        storedModules = _getStoredModules(store, versions)
+        rows.append((sourceName, sourceEnv, targetName, targetEnv, versions,
+            storedModules, len(storedModules) < len(versions)))
+
+    # Check out or update every source and target up front, then sync and
+    # commit each row in order.
+    repoSpecs = []
+    for sourceName, sourceEnv, targetName, targetEnv, _, _, needsSource in rows:
+        if needsSource:
+            repoSpecs.append((sourceName, sourceEnv))
+        repoSpecs.append((targetName, targetEnv))
+    repos = svn.ensureRepos(repoSpecs, svn.MODULES_UPDATE_SPECS,
+        jobs=args.jobs)
+
+    for (sourceName, sourceEnv, targetName, targetEnv, versions, storedModules,
+            needsSource) in rows:
+        source = repos[(sourceName, sourceEnv)] if needsSource else None
+        if source is not None and 'message' in source:
+            log.error(source['message'])
             log.error('Source repo in error state, unable to copy any modules '
                       'from %s to %s. Skipping\n', sourceName, targetName)
             continue
 
-        try:
-            target = svn.ensureRepo(targetName, svn.MODULES_UPDATE_SPECS,
-                environment=targetEnv)
-        except svn.SvnError as e:
-            log.error(e.message)
+        target = repos[(targetName, targetEnv)]
+        if 'message' in target:
+            log.error(target['message'])
             log.error('Target repo in error state, unable to copy any modules '
                       'from %s to %s. Skipping\n', sourceName, targetName)
             continue
 
         print('Syncing modules from "%s" to "%s"' % (sourceName, targetName))
-        sourceInfo = list_modules.getModuleInfo(source['path'])
-        targetInfo = list_modules.getModuleInfo(target['path'])
+        moduleNames = set(versions)
+        sourceInfo = list(storedModules.values())
+        if source is not None:
+            sourceInfo.extend(_getPinnedModules(
+                [module for module in list_modules.getModuleInfo(
+                    source['path'], source['state'])
+                    if module['name'] not in storedModules], versions,
+                moduleNames))
+        targetInfo = list_modules.getModuleInfo(target['path'],
+            target['state'])
 
         modulesToSync = _getModulesToSync(sourceInfo, targetInfo, moduleNames)
-
-        # Don't clean & commit if we're not going to move anything.
-        if len(modulesToSync) == 0:
-            continue
+        _storeModules(modulesToSync, source, store)
+        modulePaths = [os.path.join(target['path'], svn.PROJECT_MODULE_DIR,
+            os.path.basename(module['systemPath'])) for module in modulesToSync]
+        modulesToSync = _getChangedModules(modulesToSync, target)
 
         try:
-            _syncModules(modulesToSync, target)
+            changes = _syncModules(modulesToSync, target, snapshots)
+            if not args.dry_run:
+                # Also commit anything an earlier failed run left behind in
+                # the module directories of the cached working copy.
+                added, modified, deleted = svn.getUncommittedChanges(
+                    modulePaths)
+                changes.added.extend(added)
+                changes.modified.extend(modified)
+                changes.deleted.extend(deleted)
+        except svn.SvnError as e:
+            log.error(e.message + '\n')
+            continue
         except Exception as e:
             log.error('Error syncing modules to "%s", skipping commit.\n',
                       target['path'])
             continue
 
+        # Don't commit if we're not going to move anything.
+        if len(modulesToSync) == 0 and len(changes) == 0:
+            continue
+
         if args.dry_run:
-            print('\n"Clean" SVN status for', target['path'])
+            print('\n"Schedule" SVN adds and deletes for', target['path'])
             print('\n"SVN commit"', target['path'])
         else:
             try:
-                svn.cleanRepo(target['path'])
+                svn.scheduleChanges(changes.added, changes.deleted)
                 svn.commit(target['path'], 'Copying modules from ' +
-                           sourceName + ' using sync_modules.py.')
+                           sourceName + ' using sync_modules.py.',
+                           paths=changes.added + changes.modified +
+                           changes.deleted)
             except svn.SvnError as e:
                 log.error(e.message + '\n')
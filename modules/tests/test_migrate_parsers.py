@@ -0,0 +1,108 @@
+#
+# test_migrate_parsers.py
+# content-scripts
+#
+# For details and documentation:
+# http://github.com/inkling/content-scripts
+#
+# Copyright 2015 Inkling Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks that the <object> and <param> scans migrate.py updates content with
+find the same objects and params as each BeautifulSoup parser, over the same
+content fixtures.
+"""
+
+import codecs
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.dirname(os.path.dirname(TESTS_DIR)))
+
+import migrate
+
+FIXTURES_DIR = os.path.join(TESTS_DIR, 'fixtures', 'migrate')
+FIXTURES = sorted(name for name in os.listdir(FIXTURES_DIR)
+    if name.endswith('.html'))
+
+# BeautifulSoup parser names and the package each needs.
+PARSERS = [
+    ('html.parser', None),
+    ('lxml', 'lxml'),
+    ('html5lib', 'html5lib')
+]
+
+
+def _readFixture(name):
+    with codecs.open(os.path.join(FIXTURES_DIR, name), 'rb',
+            encoding='utf8') as htmlFile:
+        return htmlFile.read()
+
+def _getObjectSet(objects):
+    """Returns a sorted list of (data, params) tuples, with params a tuple of
+    the (name, value) tuples of each object's params, from _scanObjects
+    results.
+    """
+    return sorted((object['data'], tuple((param['name'], param['value'])
+            for param in object['params']))
+        for object in objects)
+
+def _getSoupObjectSet(htmlContent, parserName):
+    """Returns the objects of the content found by a BeautifulSoup parser, as
+    for _getObjectSet.
+    """
+    bs4 = pytest.importorskip('bs4')
+    soup = bs4.BeautifulSoup(htmlContent, parserName)
+    return sorted((object.get('data'), tuple(
+            (param.get('name'), param.get('value'))
+            for param in object.find_all('param')
+            if param.get('value') is not None))
+        for object in soup.find_all('object'))
+
+@pytest.fixture(params=PARSERS, ids=[parser[0] for parser in PARSERS])
+def parserName(request):
+    parserName, package = request.param
+    if package is not None:
+        pytest.importorskip(package)
+    return parserName
+
+@pytest.mark.parametrize('fixture', FIXTURES)
+def test_parsers_agree(fixture):
+    htmlContent = _readFixture(fixture)
+    objectSets = []
+    for parserName, package in PARSERS:
+        if package is not None:
+            pytest.importorskip(package)
+        objectSets.append(_getSoupObjectSet(htmlContent, parserName))
+    assert objectSets[0]
+    for objectSet in objectSets[1:]:
+        assert objectSet == objectSets[0]
+
+@pytest.mark.parametrize('fixture', FIXTURES)
+def test_scan_matches_parser(fixture, parserName):
+    htmlContent = _readFixture(fixture)
+    assert (_getObjectSet(migrate._scanObjects(htmlContent)) ==
+        _getSoupObjectSet(htmlContent, parserName))
+
+@pytest.mark.parametrize('fixture', FIXTURES)
+def test_stream_matches_parser(fixture, parserName, monkeypatch):
+    # Small chunks so tags are split across them.
+    monkeypatch.setattr(migrate, 'STREAMING_CHUNK_SIZE', 7)
+    objects = migrate._streamObjects(os.path.join(FIXTURES_DIR, fixture))
+    assert (_getObjectSet(objects) ==
+        _getSoupObjectSet(_readFixture(fixture), parserName))
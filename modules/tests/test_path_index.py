@@ -0,0 +1,80 @@
+#
+# test_path_index.py
+# content-scripts
+#
+# For details and documentation:
+# http://github.com/inkling/content-scripts
+#
+# Copyright 2015 Inkling Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks that PathIndex answers as os.path.exists would on the indexed
+volume.
+"""
+
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.dirname(os.path.dirname(TESTS_DIR)))
+
+import migrate
+
+
+@pytest.fixture
+def repoPath(tmpdir):
+    repoPath = os.path.join(str(tmpdir), 'Repo')
+    os.makedirs(os.path.join(repoPath, 'assets', 'Widgets', 'Quiz'))
+    os.makedirs(os.path.join(repoPath, '.svn'))
+    with open(os.path.join(repoPath, 'assets', 'Widgets', 'Quiz',
+            'index.html'), 'w'):
+        pass
+    return repoPath
+
+@pytest.mark.parametrize('useScandir', [True, False])
+def test_exists_matches_disk(repoPath, useScandir, monkeypatch):
+    if not useScandir:
+        monkeypatch.setattr(migrate, 'scandir', None)
+    pathIndex = migrate.PathIndex(repoPath)
+    for relativePath in ['.', 'assets', 'assets/Widgets/Quiz/index.html',
+            'assets/widgets/quiz/index.html', 'assets/missing', '.svn']:
+        path = os.path.join(repoPath, relativePath)
+        assert pathIndex.exists(path) == (os.path.exists(path) and
+            relativePath != '.svn')
+
+def test_case_insensitive_volume(repoPath, monkeypatch):
+    monkeypatch.setattr(migrate, '_isCaseInsensitive', lambda path: True)
+    pathIndex = migrate.PathIndex(repoPath)
+    assert pathIndex.exists(os.path.join(repoPath,
+        'ASSETS/widgets/quiz/Index.HTML'))
+    assert not pathIndex.exists(os.path.join(repoPath, 'assets/missing'))
+
+    pathIndex.remove(os.path.join(repoPath, 'assets/widgets'))
+    assert not pathIndex.exists(os.path.join(repoPath,
+        'assets/Widgets/Quiz/index.html'))
+    assert pathIndex.exists(os.path.join(repoPath, 'Assets'))
+
+def test_case_insensitive_listing(repoPath, monkeypatch):
+    monkeypatch.setattr(migrate, '_isCaseInsensitive', lambda path: True)
+    pathIndex = migrate.PathIndex(repoPath, ['assets', 'assets/Widgets'])
+    assert pathIndex.exists(os.path.join(repoPath, 'assets/widgets'))
+    assert not pathIndex.exists(os.path.join(repoPath, 'assets/Widgets/Quiz'))
+
+def test_detects_case_sensitivity(repoPath):
+    swappedPath = os.path.join(os.path.dirname(repoPath), 'rEPO')
+    assert (migrate._isCaseInsensitive(repoPath) ==
+        os.path.exists(swappedPath))
@@ -24,15 +24,45 @@
 import logging
 import os
 import subprocess
+import sys
+import tempfile
+import threading
+
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
 
 from s9logging import s9logging
+from svn import working_copies
 
 s9logging.configureLogging()
 log = logging.getLogger(__name__)
 
+# Working copies checked out by shortname live in this managed cache. It is
+# set up on first use, so it follows the directory the script runs in rather
+# than the one it was imported from.
+_workingCopies = None
+_workingCopiesLock = threading.Lock()
+
+# Output of svn commands run by ensureRepos worker threads is captured per
+# thread and printed in one block per repo so concurrent checkouts don't
+# interleave.
+_threadState = threading.local()
+_outputLock = threading.Lock()
+
 PROJECT_MODULE_DIR = 'assets/modules'
 TESTING_SUFFIX = '-testing'
 
+# Overrides the SVN server base URL, e.g. file:///path/to/repos/ to work
+# against local repositories. Testing projects are then found by their
+# shortname with TESTING_SUFFIX.
+SERVER_URL_VARIABLE = 'CONTENT_SCRIPTS_SVN_URL'
+
+# Maximum number of paths passed to a single svn add or delete call.
+SVN_BATCH_SIZE = 200
+
+# SVN sparse checkout depths, shallowest first.
+DEPTHS = ['empty', 'files', 'immediates', 'infinity']
+
 # Spec for module-only work such as listing, deleting, or synchronizing modules.
 MODULES_UPDATE_SPECS = [
     {
@@ -139,17 +169,276 @@ class SvnError(Exception):
         self.message = message
 
 
-def cleanRepo(path):
-    """Adds unversioned files and deletes missing files from SVN.
+class RepoSession(object):
+    """Remembers which update specs are already fresh in each working copy
+    during a single script run.
+
+    Passing a session to ensureRepo means a repo used by many CSV rows is only
+    updated once. If a later row needs paths or depths that weren't updated
+    yet, only those specs are updated, so depth is only ever widened.
+    """
+
+    def __init__(self):
+        # Repo path -> {normalized spec path: depth}
+        self._freshSpecs = {}
+        self._lock = threading.Lock()
+
+    def getStaleSpecs(self, repoPath, syncSpecs):
+        """Returns the specs in syncSpecs not yet brought up to date in
+        repoPath during this session.
+        """
+        with self._lock:
+            fresh = dict(self._freshSpecs.get(repoPath, {}))
+        return [spec for spec in syncSpecs if not _isSpecCovered(spec, fresh)]
+
+    def markFresh(self, repoPath, syncSpecs):
+        """Records that syncSpecs were brought up to date in repoPath.
+        """
+        with self._lock:
+            fresh = self._freshSpecs.setdefault(repoPath, {})
+            for spec in syncSpecs:
+                path = os.path.normpath(spec['path'])
+                if _depthRank(spec['depth']) > _depthRank(fresh.get(path)):
+                    fresh[path] = spec['depth']
+
+
+class RepoState(object):
+    """The state of a working copy's sparse paths, read with a single svn info
+    call.
+
+    Attributes:
+        path - Absolute path to the working copy root.
+        specPaths - Normalized spec paths the state was queried for.
+        nodes - Dict from path relative to the root ('.' for the root) to a
+            dict with kind, url, revision, lastChangedRevision, depth and
+            wcRoot properties. Paths not in the working copy are left out.
+    """
+
+    def __init__(self, path, specPaths, nodes):
+        self.path = path
+        self.specPaths = specPaths
+        self.nodes = nodes
+
+    @classmethod
+    def query(cls, path, syncSpecs):
+        """Returns the RepoState of the repo at path for the spec paths in
+        syncSpecs.
+
+        The root, each spec path and each of their parents are read in one
+        'svn info --xml -R --depth empty' call, which is local to the working
+        copy.
+        """
+        specPaths = sorted(set(os.path.normpath(spec['path'])
+            for spec in syncSpecs))
+        paths = set(['.'])
+        for specPath in specPaths:
+            while specPath not in paths:
+                paths.add(specPath)
+                specPath = os.path.dirname(specPath) or '.'
+
+        command = ['svn', 'info', '--xml', '-R', '--depth', 'empty'] + [
+            os.path.normpath(os.path.join(path, relativePath))
+            for relativePath in sorted(paths, key=_getPathLevel)]
+
+        # svn info fails if any target is missing from the working copy, but
+        # still prints info for the rest.
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+        try:
+            root = ElementTree.fromstring(output)
+        except ElementTree.ParseError:
+            return cls(path, specPaths, {})
+
+        nodes = {}
+        for entry in root.findall('entry'):
+            wcInfo = entry.find('wc-info')
+            if wcInfo is None:
+                continue
+            nodes[os.path.relpath(entry.get('path'), path)] = {
+                'kind': entry.get('kind'),
+                'url': entry.findtext('url'),
+                'revision': _getRevision(entry),
+                'lastChangedRevision': _getRevision(entry.find('commit')),
+                # svn leaves out depth for fully checked out directories.
+                'depth': wcInfo.findtext('depth', 'infinity'),
+                'wcRoot': wcInfo.findtext('wcroot-abspath')
+            }
+        return cls(path, specPaths, nodes)
+
+    @property
+    def url(self):
+        """URL of the working copy root, or None if it isn't a working copy.
+        """
+        return self.nodes.get('.', {}).get('url')
+
+    @property
+    def revision(self):
+        """Revision of the working copy root, or None if it isn't a working
+        copy.
+        """
+        return self.nodes.get('.', {}).get('revision')
+
+    def getNode(self, path):
+        """Returns the node dict for a path relative to the root, or None if
+        the path isn't checked out.
+        """
+        return self.nodes.get(os.path.normpath(path))
+
+    def isRepoRoot(self):
+        """Returns whether the path is a SVN repo root.
+        """
+        root = self.nodes.get('.')
+        return (root is not None and root['wcRoot'] is not None
+                and os.path.realpath(root['wcRoot']) ==
+                    os.path.realpath(self.path)
+                and os.path.isdir(os.path.join(self.path, '.svn')))
+
+
+def scheduleChanges(added, deleted):
+    """Schedules paths added to and deleted from a working copy for the next
+    commit, without a status scan of the working copy.
+
+    Args:
+        added - List of absolute paths that were created. Paths already under
+            version control are skipped.
+        deleted - List of absolute paths that were removed, or replaced by a
+            different kind of node. Unversioned paths are skipped. Deletions
+            are scheduled before additions so a replaced path ends up replaced
+            in svn.
     """
-    log.info('Cleaning up svn status for %s', path)
     try:
-        subprocess.check_call([r"svn status " + path + r" | egrep '^\?' |"
-            " awk '{print $2}' | xargs --no-run-if-empty svn add"], shell=True)
-        subprocess.check_call([r"svn status " + path + r" | egrep '^\!' |"
-            " awk '{print $2}' | xargs --no-run-if-empty svn --force delete"], shell=True)
+        _runInBatches(['svn', 'delete', '--force', '--keep-local'],
+            _getVersionedPaths(_getOutermostPaths(deleted)))
+        _runInBatches(['svn', 'add', '--force', '--parents'],
+            _getOutermostPaths(added))
     except subprocess.CalledProcessError as e:
-        raise SvnError('Unable to clean up SVN state', cause=e)
+        raise SvnError('Unable to schedule changes in SVN', cause=e)
+
+
+def getStatus(paths):
+    """Returns the svn status of everything changed under paths, read with a
+    single svn status --xml call.
+
+    Args:
+        paths - List of absolute paths in a working copy.
+
+    Returns:
+        A dict from absolute path to its svn status item, e.g. 'unversioned',
+        'missing', 'modified' or 'added'.
+    """
+    output = subprocess.check_output(['svn', 'status', '--xml'] +
+        [_escapePegRevision(path) for path in paths])
+    try:
+        root = ElementTree.fromstring(output)
+    except ElementTree.ParseError as e:
+        raise SvnError('Unable to parse SVN status', cause=e)
+
+    status = {}
+    for entry in root.iter('entry'):
+        wcStatus = entry.find('wc-status')
+        if wcStatus is not None:
+            status[os.path.abspath(entry.get('path'))] = wcStatus.get('item')
+    return status
+
+
+def getUncommittedChanges(paths):
+    """Returns the uncommitted changes under paths, read with a single svn
+    status call. Syncs add these to the changes they made themselves, so the
+    changes of an earlier run that failed before committing aren't left in
+    the working copy forever.
+
+    Args:
+        paths - List of absolute paths in a working copy. Paths that don't
+            exist are skipped.
+
+    Returns:
+        A tuple of lists of absolute paths (added, modified, deleted): the
+        unversioned paths to add, the paths already scheduled or modified,
+        which only need committing, and the missing paths to delete.
+    """
+    paths = [path for path in _getOutermostPaths(paths)
+        if os.path.lexists(path)]
+    if not paths:
+        return [], [], []
+
+    try:
+        status = getStatus(paths)
+    except subprocess.CalledProcessError as e:
+        raise SvnError('Unable to read SVN status', cause=e)
+
+    added = []
+    modified = []
+    deleted = []
+    for path, item in sorted(status.items()):
+        if item == 'unversioned':
+            added.append(path)
+        elif item == 'missing':
+            deleted.append(path)
+        elif item not in ('normal', 'none', 'ignored', 'external'):
+            modified.append(path)
+    return added, modified, deleted
+
+
+def getProjectUrl(shortName, environment='testing'):
+    """Returns the URL of the trunk of a project on the SVN server.
+    """
+    environmentSuffix = _getEnvironmentSuffix(environment)
+    serverBaseUrl = os.environ.get(SERVER_URL_VARIABLE)
+    if serverBaseUrl:
+        return '%s/%s%s/trunk' % (serverBaseUrl.rstrip('/'), shortName,
+            environmentSuffix)
+    serverBaseUrl = 'https://svn' + environmentSuffix + '.inkling.com/svn/'
+    return serverBaseUrl + shortName + '/trunk'
+
+
+def listPaths(url, depth='infinity'):
+    """Returns the paths in the repository under url, relative to it, read
+    with a single 'svn list' call. Directory paths end with a '/'.
+
+    Args:
+        url - String URL to list.
+        depth - SVN depth to list to. Defaults to everything under url.
+    """
+    log.info('Listing paths in %s', url)
+    try:
+        output = subprocess.check_output(['svn', 'list', '--depth', depth,
+            _escapePegRevision(url)])
+    except subprocess.CalledProcessError as e:
+        raise SvnError('Unable to list %s' % url, cause=e)
+    return output.decode('utf8').splitlines()
+
+
+def cat(urls):
+    """Returns the content of the files at urls, concatenated, read with a
+    single 'svn cat' call.
+
+    Raises SvnError if any of the files can't be read.
+    """
+    try:
+        return subprocess.check_output(['svn', 'cat'] +
+            [_escapePegRevision(url) for url in urls])
+    except subprocess.CalledProcessError as e:
+        raise SvnError('Unable to read %s' % ', '.join(urls), cause=e)
+
+
+def fetchPaths(paths):
+    """Brings paths missing from a sparse working copy into it along with
+    their parent directories, in as few svn update calls as possible.
+
+    Args:
+        paths - List of absolute paths in a working copy. Paths already in
+            the working copy are skipped.
+    """
+    missing = [path for path in _getOutermostPaths(paths)
+        if not os.path.lexists(path)]
+    if not missing:
+        return
+
+    try:
+        _runInBatches(['svn', 'update', '--parents'], missing)
+    except subprocess.CalledProcessError as e:
+        raise SvnError('Unable to fetch paths into the working copy', cause=e)
 
 
 def delete(path):
@@ -162,28 +451,89 @@ def delete(path):
         raise SvnError('Unable to perform SVN delete', cause=e)
 
 
-def commit(path, message):
+def commit(path, message, paths=None, changelist=None):
     """SVN commits in specified repo with message.
+
+    By default svn looks for changes in the whole working copy. Listing the
+    changed paths, or putting them in a changelist, limits the commit to them
+    so only they are crawled.
+
+    Args:
+        path - String absolute path to the working copy.
+        message - String commit message.
+        paths - List of absolute paths to commit, passed to svn with --targets.
+            Directories are committed with everything under them. Nothing is
+            committed if the list is empty.
+        changelist - String name of a changelist to commit, as set with
+            setChangelist.
     """
-    log.info('Performing SVN commit of "%s" with message "%s"', path, message)
+    command = ['svn', 'commit', '-m', message]
+    if changelist is not None:
+        command.extend(['--changelist', changelist])
+
+    targetsPath = None
+    if paths is not None:
+        paths = _getOutermostPaths(paths)
+        if not paths:
+            log.info('Nothing to commit in "%s"', path)
+            return
+        # Write the paths to a targets file rather than the command line, which
+        # has a length limit.
+        targetsFile = tempfile.NamedTemporaryFile(suffix='.targets',
+            delete=False)
+        with targetsFile:
+            for target in paths:
+                target = _escapePegRevision(target)
+                if not isinstance(target, bytes):
+                    target = target.encode('utf8')
+                targetsFile.write(target + b'\n')
+        targetsPath = targetsFile.name
+        command.extend(['--targets', targetsPath])
+        log.info('Performing SVN commit of %d paths in "%s" with message "%s"',
+            len(paths), path, message)
+    else:
+        log.info('Performing SVN commit of "%s" with message "%s"', path,
+            message)
+
     try:
-        subprocess.check_call(['svn', 'commit', '-m', message], cwd=path)
+        subprocess.check_call(command, cwd=path)
     except subprocess.CalledProcessError as e:
         raise SvnError('Unable to perform SVN commit', cause=e)
+    finally:
+        if targetsPath is not None:
+            os.remove(targetsPath)
+
 
+def setChangelist(changelist, paths):
+    """Adds paths in a working copy to a changelist, for commit.
 
-def ensureRepo(name, syncSpecs, environment='testing'):
+    Args:
+        changelist - String name of the changelist.
+        paths - List of absolute paths of files to add. svn only adds files to
+            changelists, so directories add the files under them.
+    """
+    try:
+        _runInBatches(['svn', 'changelist', '--depth', 'infinity',
+            changelist], _getOutermostPaths(paths))
+    except subprocess.CalledProcessError as e:
+        raise SvnError('Unable to set changelist %s' % changelist, cause=e)
+
+
+def ensureRepo(name, syncSpecs, environment='testing', session=None):
     """Checks out and updates an existing repo, returning a dict of repo info.
 
     Args:
         repo - Repo project short name or path to repo
         environment - Project environment. Needed only when repo is not checked
             out. Defaults to testing.
+        session - Optional RepoSession. Specs the session already brought up
+            to date in this run are not updated again.
 
     Returns:
         A dictionary representation of the repo with the following properties:
             name - The shortname of repo or specified relative path to repo.
             path - The path to the repo.
+            state - The RepoState of the repo after updating.
             message - An error message if checking out or updating the repo
                 failed.
     """
@@ -198,24 +548,165 @@ def ensureRepo(name, syncSpecs, environment='testing'):
     }
 
     if os.path.isdir(path):
-        _updateProject(path, syncSpecs)
+        _updateProjectInSession(path, syncSpecs, session)
     else:
         # 'name' is shortname rather than repo path. Still, the repo might
         # already be checked out.
         expectedRepoPath = _getRepoPath(name, environment)
         if os.path.isdir(expectedRepoPath):
             repo['path'] = expectedRepoPath
-            _updateProject(expectedRepoPath, syncSpecs)
+            _updateProjectInSession(expectedRepoPath, syncSpecs, session)
         else:
             repo['path'] = _checkoutProject(
                 name, syncSpecs, environment=environment)
+            if session is not None:
+                session.markFresh(repo['path'], syncSpecs)
+        getWorkingCopies().touch(os.path.basename(expectedRepoPath))
 
+    repo['state'] = RepoState.query(repo['path'], syncSpecs)
+    if not repo['state'].isRepoRoot():
+        raise SvnError('"%s" is not part of an SVN repo' % repo['path'])
     return repo
 
 
+def ensureRepos(repoSpecs, syncSpecs, jobs=1, session=None):
+    """Checks out and updates a set of repos, preparing up to jobs at once.
+
+    Args:
+        repoSpecs - Iterable of (name, environment) tuples, as accepted by
+            ensureRepo. Repeated tuples are only prepared once.
+        syncSpecs - Update specs applied to every repo.
+        jobs - Maximum number of repos to check out or update concurrently.
+            Defaults to 1.
+        session - Optional RepoSession shared with other ensureRepo calls.
+
+    Returns:
+        A dictionary mapping each (name, environment) tuple to the repo dict
+        returned by ensureRepo. If checking out or updating a repo failed its
+        path is None and its message property holds the error.
+    """
+    uniqueSpecs = []
+    for spec in repoSpecs:
+        if spec not in uniqueSpecs:
+            uniqueSpecs.append(spec)
+
+    concurrent = jobs > 1 and len(uniqueSpecs) > 1
+
+    def prepare(spec):
+        return _ensureRepoOrError(spec[0], syncSpecs, spec[1], session,
+            captureOutput=concurrent)
+
+    if concurrent:
+        pool = ThreadPool(min(jobs, len(uniqueSpecs)))
+        try:
+            repos = pool.map(prepare, uniqueSpecs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        repos = [prepare(spec) for spec in uniqueSpecs]
+
+    return dict(zip(uniqueSpecs, repos))
+
+
+def _ensureRepoOrError(name, syncSpecs, environment, session,
+        captureOutput=False):
+    """Calls ensureRepo, returning a repo dict with a message rather than
+    raising SvnError. If captureOutput is set, svn output is held back and
+    printed in one block once the repo is ready.
+    """
+    if captureOutput:
+        _threadState.output = []
+    try:
+        return ensureRepo(name, syncSpecs, environment=environment,
+            session=session)
+    except SvnError as e:
+        return {
+            'name': name,
+            'path': None,
+            'message': e.message
+        }
+    finally:
+        if captureOutput:
+            output = ''.join(_threadState.output)
+            _threadState.output = None
+            if output:
+                with _outputLock:
+                    sys.stdout.write(output)
+                    sys.stdout.flush()
+
+
+def _checkCall(command, **kwargs):
+    """Runs command like subprocess.check_call, capturing its output if the
+    current thread is preparing a repo for ensureRepos.
+    """
+    output = getattr(_threadState, 'output', None)
+    if output is None:
+        subprocess.check_call(command, **kwargs)
+        return
+
+    try:
+        output.append(subprocess.check_output(command,
+            stderr=subprocess.STDOUT, universal_newlines=True, **kwargs))
+    except subprocess.CalledProcessError as e:
+        output.append(e.output or '')
+        raise
+
+
+def _updateProjectInSession(projectPath, syncSpecs, session):
+    """Updates the svn project at projectPath, skipping specs the session has
+    already updated.
+    """
+    if session is None:
+        _updateProject(projectPath, syncSpecs)
+        return
+
+    staleSpecs = session.getStaleSpecs(projectPath, syncSpecs)
+    if staleSpecs:
+        _updateProject(projectPath, staleSpecs)
+        session.markFresh(projectPath, staleSpecs)
+    else:
+        log.info('SVN project %s already updated in this run', projectPath)
+
+
+def _depthRank(depth):
+    """Returns the position of depth in DEPTHS, or -1 if it is unknown.
+    """
+    return DEPTHS.index(depth) if depth in DEPTHS else -1
+
+
+def _isSpecCovered(spec, freshSpecs):
+    """Returns whether spec is satisfied by freshSpecs, a dict of normalized
+    paths to depths. A path is covered by the same path at an equal or
+    deeper depth, or by any ancestor updated at infinity.
+    """
+    path = os.path.normpath(spec['path'])
+    if (path in freshSpecs and
+            _depthRank(freshSpecs[path]) >= _depthRank(spec['depth'])):
+        return True
+
+    parent = path
+    while parent not in ('.', '', os.sep):
+        parent = os.path.dirname(parent) or '.'
+        if freshSpecs.get(parent) == 'infinity':
+            return True
+    return False
+
+
+def getWorkingCopies():
+    """Returns the WorkingCopyCache of the projects checked out by shortname,
+    configured by environment variables on first use.
+    """
+    global _workingCopies
+    with _workingCopiesLock:
+        if _workingCopies is None:
+            _workingCopies = working_copies.WorkingCopyCache.fromEnvironment()
+        return _workingCopies
+
+
 def _getRepoPath(shortName, environment):
-    return os.path.join(os.getcwd(),
-                        shortName + _getEnvironmentSuffix(environment))
+    return getWorkingCopies().getPath(shortName +
+        _getEnvironmentSuffix(environment))
 
 
 def _getEnvironmentSuffix(environment):
@@ -226,9 +717,7 @@ def _checkoutProject(shortName, syncSpecs, environment='testing'):
     """Checks out an SVN project into the working directory and returns project
     root path.
     """
-    environmentSuffix = _getEnvironmentSuffix(environment)
-    serverBaseUrl = 'https://svn' + environmentSuffix + '.inkling.com/svn/'
-    serverUrl = serverBaseUrl + shortName + '/trunk'
+    serverUrl = getProjectUrl(shortName, environment)
     destinationPath = _getRepoPath(shortName, environment)
 
     log.info('Performing SVN checkout of %s as %s',
@@ -236,7 +725,7 @@ def _checkoutProject(shortName, syncSpecs, environment='testing'):
     # Checkout empty trunk of project repo to be sure it exists and have a fully
     # functional repo.
     try:
-        subprocess.check_call(['svn', 'checkout',
+        _checkCall(['svn', 'checkout',
             serverUrl,
             destinationPath,
             '--depth', 'empty'])
@@ -249,30 +738,230 @@ def _checkoutProject(shortName, syncSpecs, environment='testing'):
 
 def _updateProject(projectPath, syncSpecs):
     """Updates the svn project at projectPath.
+
+    The current depth of every spec path is read with one svn info call. Spec
+    paths that are already deep enough are updated together in a single svn
+    update, and the rest are grouped into as few svn update --set-depth calls
+    as possible, each with several targets. Depths are never made shallower.
+
+    If no depths need changing, the update is skipped when the server has no
+    newer commits for the spec paths and they have no local modifications.
+
+    Returns:
+        The number of svn calls saved compared to checking and updating each
+        spec separately.
     """
     log.info('Performing SVN update of %s', projectPath)
-    if not _isRepoRoot(projectPath):
+    state = RepoState.query(projectPath, syncSpecs)
+    if not state.isRepoRoot():
         raise SvnError('"%s" is not part of an SVN repo' % projectPath)
-
-    for spec in syncSpecs:
-        path = os.path.normpath(os.path.join(projectPath, spec['path']))
+    calls = 1
+
+    batches = _getUpdateBatches(_getNormalizedSpecs(syncSpecs), state)
+    if len(batches) == 1 and batches[0][0] is None:
+        upToDate, checkCalls = _isUpToDate(state, batches[0][1])
+        calls += checkCalls
+        if upToDate:
+            log.info('No new revisions for %s, skipping update', projectPath)
+            batches = []
+
+    for depth, paths in batches:
+        command = ['svn', 'update']
+        if depth is not None:
+            command.extend(['--set-depth', depth, '--parents'])
+        command.extend([os.path.normpath(os.path.join(projectPath, path))
+            for path in paths])
         try:
-            if subprocess.call(['svn info %s | grep "Depth: %s"' % (
-                    path, spec['depth'])], shell=True) == 0:
-                subprocess.check_call(['svn', 'update', path, 'depth',
-                    spec['depth']])
-            else:
-                subprocess.check_call(['svn', 'update', path,
-                    '--set-depth', spec['depth'], '--parents'])
+            _checkCall(command)
         except subprocess.CalledProcessError as e:
             raise SvnError('Unable to update SVN project at "%s"' % projectPath,
                 cause=e)
+    calls += len(batches)
+
+    # Checking and updating each spec separately takes an svn info and an svn
+    # update per spec plus an svn info to check the repo root.
+    saved = 1 + 2 * len(syncSpecs) - calls
+    log.info('Updated %s with %d svn calls, saving %d round trips',
+        projectPath, calls, saved)
+    return saved
+
+
+def _isUpToDate(state, paths):
+    """Returns whether the checked out paths have no newer commits on the
+    server and no local modifications.
+
+    The last changed revision of every path on the server is read with one
+    svn info call and compared with the revision of the working copy.
+
+    Returns:
+        A tuple of whether the paths are up to date, and the number of svn
+        calls made to find out.
+    """
+    revisions = {}
+    for path in paths:
+        node = state.getNode(path)
+        revisions[node['url']] = node['revision']
+
+    process = subprocess.Popen(['svn', 'info', '--xml', '--depth', 'empty'] +
+        [_escapePegRevision(url) for url in revisions],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        return False, 1
+    try:
+        root = ElementTree.fromstring(output)
+    except ElementTree.ParseError:
+        return False, 1
+
+    serverRevisions = dict((entry.findtext('url'),
+        _getRevision(entry.find('commit'))) for entry in root.findall('entry'))
+    for url, revision in revisions.items():
+        serverRevision = serverRevisions.get(url)
+        if revision is None or serverRevision is None or \
+                serverRevision > revision:
+            return False, 1
+
+    try:
+        status = getStatus([os.path.normpath(os.path.join(state.path, path))
+            for path in paths])
+    except (subprocess.CalledProcessError, SvnError):
+        return False, 2
+    return all(item == 'unversioned' for item in status.values()), 2
+
+
+def _getNormalizedSpecs(syncSpecs):
+    """Returns a list of (normalized path, depth) tuples for syncSpecs, sorted
+    so parents come before their children. Repeated paths keep their deepest
+    depth and paths under an infinity path are dropped.
+    """
+    depths = {}
+    for spec in syncSpecs:
+        path = os.path.normpath(spec['path'])
+        if _depthRank(spec['depth']) > _depthRank(depths.get(path)):
+            depths[path] = spec['depth']
+
+    infinityPaths = [path for path, depth in depths.items()
+        if depth == 'infinity']
+    specs = [(path, depth) for path, depth in depths.items()
+        if not any(_isAncestorPath(other, path) for other in infinityPaths)]
+    return sorted(specs, key=lambda spec: (_getPathLevel(spec[0]), spec[0]))
+
+
+def _getUpdateBatches(specs, state):
+    """Groups specs into svn update calls.
+
+    Args:
+        specs - Normalized (path, depth) tuples, parents first.
+        state - RepoState of the repo before updating.
+
+    Returns:
+        A list of (depth, paths) tuples to run in order. Depth is the depth to
+        set with --set-depth, or None for a plain update of paths that are
+        already deep enough. Each set-depth batch comes after any batch that
+        sets the depth of a parent path.
+    """
+    depthBatches = []
+    batchIndexes = {}
+    plainPaths = []
+    for path, depth in specs:
+        current = state.getNode(path)
+        if current is not None and (current['kind'] == 'file' or
+                _depthRank(current['depth']) >= _depthRank(depth)):
+            # A plain update of a parent already updates the path, at the
+            # depth it is checked out to.
+            if not any(_isAncestorPath(other, path) for other in plainPaths):
+                plainPaths.append(path)
+            continue
+
+        firstIndex = 0
+        for other, index in batchIndexes.items():
+            if _isAncestorPath(other, path):
+                firstIndex = max(firstIndex, index + 1)
+        for index in range(firstIndex, len(depthBatches)):
+            if depthBatches[index][0] == depth:
+                break
+        else:
+            index = len(depthBatches)
+            depthBatches.append((depth, []))
+        depthBatches[index][1].append(path)
+        batchIndexes[path] = index
+
+    if plainPaths:
+        depthBatches.append((None, plainPaths))
+    return depthBatches
+
+
+def _getPathLevel(path):
+    """Returns how many directories deep the normalized relative path is.
+    """
+    return 0 if path == '.' else path.count('/') + 1
+
+
+def _isAncestorPath(ancestor, path):
+    """Returns whether normalized relative path ancestor contains path.
+    """
+    return ancestor != path and (ancestor == '.' or
+        path.startswith(ancestor + '/'))
+
+
+def _getOutermostPaths(paths):
+    """Returns the sorted paths that aren't inside another of the paths.
+    svn adds and deletes directories along with everything under them.
+    """
+    pathSet = set(paths)
+    outermost = []
+    for path in sorted(pathSet):
+        parent = os.path.dirname(path)
+        while parent not in pathSet and parent != os.path.dirname(parent):
+            parent = os.path.dirname(parent)
+        if parent not in pathSet:
+            outermost.append(path)
+    return outermost
+
+
+def _getVersionedPaths(paths):
+    """Returns the paths that are under version control, read with svn info
+    --depth empty so nothing else in the working copy is walked.
+    """
+    versioned = set()
+    for index in range(0, len(paths), SVN_BATCH_SIZE):
+        # svn info fails if any target isn't versioned, but still prints info
+        # for the rest.
+        process = subprocess.Popen(['svn', 'info', '--xml', '--depth',
+            'empty'] + [_escapePegRevision(path)
+            for path in paths[index:index + SVN_BATCH_SIZE]],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+        try:
+            root = ElementTree.fromstring(output)
+        except ElementTree.ParseError as e:
+            raise SvnError('Unable to parse SVN info', cause=e)
+        for entry in root.findall('entry'):
+            versioned.add(os.path.abspath(entry.get('path')))
+    return [path for path in paths if path in versioned]
+
+
+def _runInBatches(command, paths):
+    """Runs command with paths appended, at most SVN_BATCH_SIZE at a time.
+    """
+    for index in range(0, len(paths), SVN_BATCH_SIZE):
+        batch = paths[index:index + SVN_BATCH_SIZE]
+        log.info('Running %s on %d paths', ' '.join(command), len(batch))
+        subprocess.check_call(command +
+            [_escapePegRevision(path) for path in batch])
+
+
+def _escapePegRevision(path):
+    """Returns path with a trailing '@' if it contains one, so svn doesn't read
+    the end of the path as a peg revision.
+    """
+    return path + '@' if '@' in path else path
+
 
-def _isRepoRoot(path):
-    """Returns whether the path is a SVN repo root.
+def _getRevision(element):
+    """Returns the revision attribute of an svn info XML element as an int,
+    or None if it is missing.
     """
-    # If SVN info returns without an error then path is part of a repo.
-    return (subprocess.call(['svn', 'info', path],
-                            stdout=open(os.devnull, 'w'),
-                            close_fds=True) == 0
-            and os.path.isdir(os.path.join(path, '.svn')))
+    if element is None or not element.get('revision', '').isdigit():
+        return None
+    return int(element.get('revision'))
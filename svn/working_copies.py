@@ -0,0 +1,338 @@
+# working_copies.py
+# content-scripts
+#
+# For details and documentation:
+# http://github.com/inkling/content-scripts
+#
+# Copyright 2015 Inkling Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A managed directory of project working copies.
+
+Working copies are kept between runs so projects don't need to be checked out
+again. The cache records when each copy was last used and how much disk it
+takes, and removes the least recently used copies once the cache is over its
+quota. It is configured with environment variables:
+
+    CONTENT_SCRIPTS_WC_DIR - Directory holding the working copies. Defaults to
+        the current directory.
+    CONTENT_SCRIPTS_WC_QUOTA_MB - Disk quota in megabytes. No copies are
+        removed if unset.
+    CONTENT_SCRIPTS_WC_VACUUM - If set to 1, run svn cleanup
+        --vacuum-pristines on cached copies before removing any of them.
+
+Several runs can share the cache directory. Each run holds a shared lock on the
+lock file of every copy it uses, and a copy is only removed while its lock can
+be taken exclusively, so no run removes a copy another run is using. Locks are
+released when a run exits, however it exits.
+"""
+
+import json
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import threading
+import time
+from xml.etree import ElementTree
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (on Windows) copies are only protected within a run.
+    fcntl = None
+
+from s9logging import s9logging
+
+s9logging.configureLogging()
+log = logging.getLogger(__name__)
+
+CACHE_DIR_VARIABLE = 'CONTENT_SCRIPTS_WC_DIR'
+QUOTA_VARIABLE = 'CONTENT_SCRIPTS_WC_QUOTA_MB'
+VACUUM_VARIABLE = 'CONTENT_SCRIPTS_WC_VACUUM'
+
+# Index of cached working copies, kept in the cache directory.
+INDEX_FILE = '.working-copies.json'
+
+# Lock files, kept in the cache directory. The index lock is held while the
+# index is read, updated and written.
+INDEX_LOCK_FILE = '.working-copies.lock'
+LOCK_FILE_FORMAT = '.%s.lock'
+
+# Sizes of the directories of a working copy, kept in its .svn directory so its
+# size can be updated without reading every file.
+SIZES_FILE = 'content-scripts-sizes.json'
+
+# svn status items of paths without local changes. Anything else, including
+# unversioned files, keeps a working copy from being evicted.
+UNCHANGED_STATUS_ITEMS = frozenset(['normal', 'none', 'ignored', 'external'])
+
+
+class WorkingCopyCache(object):
+    """A directory of working copies with least recently used eviction.
+
+    Attributes:
+        directory - Absolute path of the cache directory.
+        quota - Maximum total size of the cached copies in bytes, or None for
+            no limit.
+        vacuum - Whether to vacuum pristine files before evicting copies.
+    """
+
+    def __init__(self, directory, quota=None, vacuum=False):
+        self.directory = os.path.abspath(directory)
+        self.quota = quota
+        self.vacuum = vacuum
+        # Copies used by this run are never evicted by it, and are locked so
+        # other runs don't evict them either.
+        self._inUse = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromEnvironment(cls):
+        """Returns a WorkingCopyCache configured by environment variables.
+        """
+        quota = os.environ.get(QUOTA_VARIABLE)
+        return cls(os.environ.get(CACHE_DIR_VARIABLE, os.getcwd()),
+            quota=int(quota) * 1024 * 1024 if quota else None,
+            vacuum=os.environ.get(VACUUM_VARIABLE) == '1')
+
+    def getPath(self, key):
+        """Returns the path of the working copy for key and marks it as in use
+        so it isn't evicted during this run.
+
+        Args:
+            key - Directory name of the working copy, unique to a project
+                shortname and environment.
+        """
+        with self._lock:
+            self._inUse.add(key)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            if key not in self._locks:
+                self._locks[key] = self._openLock(LOCK_FILE_FORMAT % key,
+                    exclusive=False)
+        return os.path.join(self.directory, key)
+
+    def touch(self, key):
+        """Records that the working copy for key was just used, then evicts
+        least recently used copies if the cache is over quota.
+        """
+        with self._lock:
+            indexLock = self._openLock(INDEX_LOCK_FILE, exclusive=True)
+            try:
+                index = self._readIndex()
+                index[key] = {
+                    'lastUsed': time.time(),
+                    'size': _getSize(os.path.join(self.directory, key))
+                        if self.quota is not None else None
+                }
+                if self.quota is not None:
+                    self._evict(index)
+                self._writeIndex(index)
+            finally:
+                if indexLock is not None:
+                    indexLock.close()
+
+    def _evict(self, index):
+        """Removes least recently used copies from disk and index until the
+        cache is under quota.
+        """
+        for key in list(index):
+            path = os.path.join(self.directory, key)
+            if not os.path.isdir(path):
+                del index[key]
+            elif index[key]['size'] is None:
+                index[key]['size'] = _getSize(path)
+
+        if _getTotalSize(index) <= self.quota:
+            return
+
+        candidates = sorted([key for key in index if key not in self._inUse],
+            key=lambda key: index[key]['lastUsed'])
+
+        if self.vacuum:
+            for key in candidates:
+                path = os.path.join(self.directory, key)
+                log.info('Vacuuming pristine files of %s', path)
+                if subprocess.call(['svn', 'cleanup', '--vacuum-pristines',
+                        path]) == 0:
+                    index[key]['size'] = _getSize(path)
+            if _getTotalSize(index) <= self.quota:
+                return
+
+        for key in candidates:
+            path = os.path.join(self.directory, key)
+            copyLock = self._openLock(LOCK_FILE_FORMAT % key, exclusive=True,
+                blocking=False)
+            if copyLock is None and fcntl is not None:
+                log.info('Not evicting %s from the working copy cache, another '
+                    'run is using it.', path)
+                continue
+
+            try:
+                if _hasLocalChanges(path):
+                    log.warning('Not evicting %s from the working copy cache, '
+                        'it has uncommitted changes.', path)
+                    continue
+
+                log.info('Evicting least recently used working copy %s', path)
+                shutil.rmtree(path)
+                del index[key]
+            finally:
+                if copyLock is not None:
+                    copyLock.close()
+            if _getTotalSize(index) <= self.quota:
+                return
+
+        log.warning('Working copy cache %s is still over its quota of %d MB.',
+            self.directory, self.quota // (1024 * 1024))
+
+    def _openLock(self, name, exclusive, blocking=True):
+        """Opens and locks a lock file in the cache directory, returning the
+        open file, which holds the lock until it is closed.
+
+        Returns None if the lock isn't available without blocking, or if
+        locking isn't supported.
+        """
+        if fcntl is None:
+            return None
+        lockFile = open(os.path.join(self.directory, name), 'a')
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lockFile.fileno(), operation)
+        except IOError:
+            lockFile.close()
+            return None
+        return lockFile
+
+    def _readIndex(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE)) as indexFile:
+                return json.load(indexFile)
+        except (IOError, ValueError):
+            return {}
+
+    def _writeIndex(self, index):
+        # Write then rename so an interrupted run never leaves a partial index.
+        indexPath = os.path.join(self.directory, INDEX_FILE)
+        with open(indexPath + '.tmp', 'w') as indexFile:
+            json.dump(index, indexFile, indent=2, sort_keys=True)
+        os.rename(indexPath + '.tmp', indexPath)
+
+
+def _getSize(path):
+    """Returns the total size in bytes of the files under path.
+
+    The size of the files directly in each directory is kept in the working
+    copy's .svn directory along with the directory's modification time. svn
+    replaces files rather than writing them in place, so only directories
+    modified since the last call are listed again.
+    """
+    sizesPath = os.path.join(path, '.svn', SIZES_FILE)
+    hasSvnDir = os.path.isdir(os.path.dirname(sizesPath))
+    cached = {}
+    if hasSvnDir:
+        try:
+            with open(sizesPath) as sizesFile:
+                cached = json.load(sizesFile)
+        except (IOError, ValueError):
+            pass
+
+    sizes = {}
+    size = _getDirectorySize(path, '', cached, sizes)
+
+    if hasSvnDir and sizes != cached:
+        with open(sizesPath + '.tmp', 'w') as sizesFile:
+            json.dump(sizes, sizesFile)
+        os.rename(sizesPath + '.tmp', sizesPath)
+    return size
+
+
+def _getDirectorySize(path, relativePath, cached, sizes):
+    """Returns the total size of the files under a directory of a working
+    copy, adding an entry for it and each directory under it to sizes.
+
+    Args:
+        path - String absolute path to the working copy.
+        relativePath - String path of the directory relative to path.
+        cached - Dict of previously computed sizes entries.
+        sizes - Dict from directory path relative to path to a dict of its
+            modification time, the size of the files directly in it and the
+            names of its subdirectories.
+    """
+    dirPath = os.path.join(path, relativePath)
+    try:
+        dirStat = os.lstat(dirPath)
+    except OSError:
+        return 0
+
+    entry = cached.get(relativePath)
+    # svn writes its database in place, so .svn itself is always listed.
+    if (entry is None or entry['mtime'] != dirStat.st_mtime or
+            os.path.basename(dirPath) == '.svn'):
+        entry = {
+            'mtime': dirStat.st_mtime,
+            'size': 0,
+            'dirs': []
+        }
+        try:
+            names = os.listdir(dirPath)
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                childStat = os.lstat(os.path.join(dirPath, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(childStat.st_mode):
+                entry['dirs'].append(name)
+            else:
+                entry['size'] += childStat.st_size
+    sizes[relativePath] = entry
+
+    return entry['size'] + sum(_getDirectorySize(path,
+        os.path.join(relativePath, _toNativeName(name)), cached, sizes)
+        for name in entry['dirs'])
+
+
+def _toNativeName(name):
+    # Names read back from JSON are unicode, but Python 2 paths are bytes.
+    if not isinstance(name, str):
+        return name.encode('utf8')
+    return name
+
+
+def _getTotalSize(index):
+    return sum(entry['size'] or 0 for entry in index.values())
+
+
+def _hasLocalChanges(path):
+    """Returns whether the working copy at path has uncommitted changes,
+    including unversioned files, or its status can't be read.
+    """
+    process = subprocess.Popen(['svn', 'status', '--xml', path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        return True
+    try:
+        root = ElementTree.fromstring(output)
+    except ElementTree.ParseError:
+        return True
+    return any(status.get('item') not in UNCHANGED_STATUS_ITEMS
+        for status in root.iter('wc-status'))
@@ -35,7 +35,8 @@ source_shortname,source_environment,destination_shortname,destination_environmen
 
 * The exclude file is optional and its path is relative to where the script is
 running. The file format is the rsync exclude file format and files should be
-relative to the paths that are being copied.
+relative to the paths that are being copied. Files are synced in process rather
+than with rsync, and excluded files are neither copied nor deleted.
 
 * Paths to sync are relative to project trunk. Paths can specify either a file
 or a directory but if it is a directory the path must end in a trailing slash.
@@ -52,6 +53,7 @@ import os
 import subprocess
 from s9logging import s9logging
 import svn.project_svn as svn
+from sync import tree_sync
 import sys
 sys.path.insert(1, os.getcwd())
 
@@ -68,6 +70,9 @@ s9logging.configureLogging()
 log = logging.getLogger(__name__)
 basePath = ''
 
+# Directory, relative to project trunk, that Sass is compiled into.
+COMPILED_CSS_DIR = 'assets/css'
+
 def _getSyncSpecsFromCsv():
     """Returns a list of tuples of the form (source name, source environment,
     destination name, destination environment, exclude file, set of paths to
@@ -99,6 +104,15 @@ if __name__ == '__main__':
 
     syncSpecs = _getSyncSpecsFromCsv()
 
+    # A source is usually synced to many targets. Only update each project
+    # once per run.
+    session = svn.RepoSession()
+
+    # Exclude rules by exclude file path and source snapshots by (source
+    # path, exclude file path, paths), shared between rows.
+    excludeRules = {}
+    snapshots = {}
+
     for sourceName, sourceEnv, targetName, targetEnv, excludeFile, \
             pathsToSync in syncSpecs:
 
@@ -112,7 +126,7 @@ if __name__ == '__main__':
         # Update source & target.
         try:
             source = svn.ensureRepo(sourceName, svn.STYLES_UPDATE_SPECS,
-                environment=sourceEnv)
+                environment=sourceEnv, session=session)
         except svn.SvnError as e:
             log.error(e.message)
             log.error('Source repo in error state, unable to copy any styles '
@@ -121,59 +135,94 @@ if __name__ == '__main__':
 
         try:
             target = svn.ensureRepo(targetName, svn.STYLES_UPDATE_SPECS,
-                environment=targetEnv)
+                environment=targetEnv, session=session)
         except svn.SvnError as e:
             log.error(e.message)
             log.error('Target repo in error state, unable to copy any styles '
                       'from %s to %s. Skipping\n', sourceName, targetName)
             continue
 
-        # For each path rsync
-        for path in pathsToSync:
-            command = ['rsync', '--recursive', '-v']
-
-            if args.delete:
-                command.append('--delete')
-
-            if excludeFile:
-                command.extend(['--exclude-from', excludeFile])
-
-            command.extend([os.path.join(source['path'], path),
-                            os.path.join(target['path'],path)])
-
-            if args.dry_run:
-                print('"rsync" with %s' % command)
-            else:
-                try:
-                    log.info('Excuting rsync: %s', command)
-                    subprocess.check_call(command)
+        # Sync all of the row's paths in one pass, keeping track of exactly
+        # what changed so it can be added to and deleted from svn without a
+        # status scan. A source synced to several targets with the same paths
+        # and exclude file is only listed once.
+        snapshotKey = (source['path'], excludeFilePath if excludeFile else None,
+            tuple(sorted(pathsToSync)))
+        if args.dry_run:
+            for path in sorted(pathsToSync):
+                print('"Sync" %s to %s' % (os.path.join(source['path'], path),
+                    os.path.join(target['path'], path)))
+            changes = tree_sync.TreeChanges()
+        else:
+            try:
+                if snapshotKey not in snapshots:
+                    if excludeFile and excludeFilePath not in excludeRules:
+                        excludeRules[excludeFilePath] = \
+                            tree_sync.ExcludeRules.fromFile(excludeFilePath)
+                    snapshots[snapshotKey] = tree_sync.TreeSnapshot(
+                        source['path'], excludeRules.get(snapshotKey[1]),
+                        roots=snapshotKey[2])
+                snapshot = snapshots[snapshotKey]
+                for path in snapshot.missing:
+                    log.error('Path "%s" does not exist in %s, not syncing it.',
+                        path, source['path'])
+
+                log.info('Syncing %d paths from %s to %s', len(snapshot.roots),
+                    source['path'], target['path'])
+                # Working copies don't keep the source's modification times,
+                # so compare content before rewriting a file.
+                changes = tree_sync.syncTree(snapshot, target['path'],
+                    delete=args.delete, checksum=True)
+            except (IOError, OSError) as e:
+                log.error('Unable to sync %s to %s: %s', source['path'],
+                    target['path'], e)
+                log.error('Sync error, skipping commit.')
+                continue
 
-                except subprocess.CalledProcessError as e:
-                    log.error(e.message)
-                    continue
+            # The target's files are changing, so snapshots of it are stale.
+            for key in [key for key in snapshots if key[0] == target['path']]:
+                del snapshots[key]
 
-        # Compile Sass.
+        # Compile Sass, recording the CSS it writes.
         sassCommand = ['compass', 'compile', target['path']]
+        cssPath = os.path.join(target['path'], COMPILED_CSS_DIR)
 
         if args.dry_run:
             print('"Compile Sass" with %s' % sassCommand)
         else:
             try:
                 log.info('Compiling Sass: %s', sassCommand)
+                cssBefore = tree_sync.TreeSnapshot(cssPath) \
+                    if os.path.isdir(cssPath) else None
                 subprocess.check_call(sassCommand)
+                if cssBefore is None:
+                    if os.path.isdir(cssPath):
+                        changes.added.append(cssPath)
+                elif os.path.isdir(cssPath):
+                    changes.extend(tree_sync.diffSnapshots(cssBefore,
+                        tree_sync.TreeSnapshot(cssPath)))
             except subprocess.CalledProcessError as e:
                 log.error(e.message)
                 log.error('Sass compilation error, skipping commit.')
                 continue
 
-        # Clean up svn status and commit.
+        # Schedule svn adds and deletes, and commit.
         if args.dry_run:
-            print('"Clean" SVN status for %s' % target['path'])
+            print('"Schedule" SVN adds and deletes for %s' % target['path'])
             print('"SVN commit" for %s' % target['path'])
         else:
             try:
-                svn.cleanRepo(target['path'])
-                svn.commit(target['path'], 'Syncing styles with sync_styles.py script.')
+                # Also commit anything an earlier failed run left behind in
+                # the synced paths of the cached working copy.
+                added, modified, deleted = svn.getUncommittedChanges(
+                    [os.path.join(target['path'], path)
+                        for path in pathsToSync] + [cssPath])
+                changes.added.extend(added)
+                changes.modified.extend(modified)
+                changes.deleted.extend(deleted)
+                svn.scheduleChanges(changes.added, changes.deleted)
+                svn.commit(target['path'], 'Syncing styles with sync_styles.py script.',
+                    paths=changes.added + changes.modified + changes.deleted)
             except svn.SvnError as e:
                 log.error(e.message)
                 continue
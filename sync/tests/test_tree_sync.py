@@ -0,0 +1,171 @@
+#
+# test_tree_sync.py
+# content-scripts
+#
+# For details and documentation:
+# http://github.com/inkling/content-scripts
+#
+# Copyright 2015 Inkling Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks that tree_sync honours rsync exclude files as sync_styles uses
+them.
+"""
+
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(TESTS_DIR)))
+
+from sync import tree_sync
+
+
+def _writeFiles(rootPath, relativePaths):
+    for relativePath in relativePaths:
+        path = os.path.join(rootPath, relativePath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as writtenFile:
+            writtenFile.write(relativePath)
+
+def _listFiles(rootPath):
+    return sorted(os.path.relpath(os.path.join(directoryPath, name), rootPath)
+        for directoryPath, directoryNames, fileNames in os.walk(rootPath)
+        for name in directoryNames + fileNames)
+
+@pytest.mark.parametrize('pattern, relativePath, isDirectory, excluded', [
+    # A pattern without a '/' matches the name at any depth.
+    ('custom.css', 'custom.css', False, True),
+    ('custom.css', 'assets/css/custom.css', False, True),
+    ('custom.css', 'assets/css/custom.css.map', False, False),
+    ('custom.css', 'notcustom.css', False, False),
+    # A leading '/' anchors the pattern to the root.
+    ('/custom.css', 'custom.css', False, True),
+    ('/custom.css', 'assets/custom.css', False, False),
+    ('/sub/deep/x.txt', 'sub/deep/x.txt', False, True),
+    ('/sub/deep/x.txt', 'a/sub/deep/x.txt', False, False),
+    # A pattern with another '/' matches the end of the path.
+    ('sub/deep/x.txt', 'a/sub/deep/x.txt', False, True),
+    ('deep/x.txt', 'sub/deep/x.txt', False, True),
+    ('deep/x.txt', 'sub/notdeep/x.txt', False, False),
+    # '*' and '?' don't match '/', '**' does.
+    ('*.css', 'assets/css/a.css', False, True),
+    ('assets/*.css', 'assets/css/a.css', False, False),
+    ('assets/**.css', 'assets/css/a.css', False, True),
+    ('/assets/**/a.css', 'assets/css/sub/a.css', False, True),
+    ('a?.css', 'ab.css', False, True),
+    ('a?.css', 'a/.css', False, False),
+    # Character classes, negated with '!'.
+    ('[ab].css', 'a.css', False, True),
+    ('[ab].css', 'c.css', False, False),
+    ('[!ab].css', 'c.css', False, True),
+    ('[!ab].css', 'a.css', False, False),
+    # A trailing '/' only matches directories.
+    ('partials/', 'assets/sass/partials', True, True),
+    ('partials/', 'assets/sass/partials', False, False),
+    # Regular expression characters are literal.
+    ('a+b.css', 'a+b.css', False, True),
+    ('a.css', 'abcss', False, False),
+])
+def test_pattern(pattern, relativePath, isDirectory, excluded):
+    rules = tree_sync.ExcludeRules([pattern])
+    assert rules.isExcluded(relativePath, isDirectory) == excluded
+
+def test_prefixes_and_first_match():
+    rules = tree_sync.ExcludeRules([
+        '# A comment',
+        '; Another comment',
+        '',
+        '+ keep.css',
+        '- *.css',
+        '+ *.scss',
+    ])
+    assert not rules.isExcluded('keep.css', False)
+    assert rules.isExcluded('other.css', False)
+    assert not rules.isExcluded('a.scss', False)
+    assert not rules.isExcluded('a.txt', False)
+    assert len(rules.rules) == 3
+
+def test_exclude_file(tmpdir):
+    excludePath = os.path.join(str(tmpdir), 'exclude.txt')
+    with open(excludePath, 'w') as excludeFile:
+        excludeFile.write('# Compiled\r\ncustom.css\r\n\r\n/toc.s9ml\r\n')
+    rules = tree_sync.ExcludeRules.fromFile(excludePath)
+    assert rules.isExcluded('assets/css/custom.css', False)
+    assert rules.isExcluded('toc.s9ml', False)
+    assert not rules.isExcluded('s9ml/toc.s9ml', False)
+
+def test_patterns_match_relative_to_each_root(tmpdir):
+    sourcePath = os.path.join(str(tmpdir), 'source')
+    _writeFiles(sourcePath, ['assets/css/a.css', 'assets/css/b.css',
+        'assets/css/sub/a.css', 'assets/sass/a.css', 's9ml/toc.s9ml',
+        's9ml/sub/toc.s9ml'])
+    snapshot = tree_sync.TreeSnapshot(sourcePath,
+        tree_sync.ExcludeRules(['/a.css', '/toc.s9ml']),
+        roots=['assets/css/', 'assets/sass/', 's9ml/'])
+
+    # Anchored patterns match at the top of each root, as for a separate
+    # rsync of each root's contents.
+    assert sorted(snapshot.files) == ['assets/css/b.css',
+        'assets/css/sub/a.css', 's9ml/sub/toc.s9ml']
+    assert 'assets/sass' in snapshot.directories
+
+def test_excluded_file_root_creates_no_directories(tmpdir):
+    sourcePath = os.path.join(str(tmpdir), 'source')
+    targetPath = os.path.join(str(tmpdir), 'target')
+    _writeFiles(sourcePath, ['s9ml/deep/toc.s9ml', 'other/keep.txt'])
+    snapshot = tree_sync.TreeSnapshot(sourcePath,
+        tree_sync.ExcludeRules(['toc.s9ml']),
+        roots=['s9ml/deep/toc.s9ml', 'other/keep.txt'])
+
+    changes = tree_sync.syncTree(snapshot, targetPath)
+    assert _listFiles(targetPath) == ['other', 'other/keep.txt']
+    assert sorted(os.path.relpath(path, targetPath)
+        for path in changes.added) == ['.', 'other', 'other/keep.txt']
+
+def test_delete_leaves_excluded_paths(tmpdir):
+    sourcePath = os.path.join(str(tmpdir), 'source')
+    targetPath = os.path.join(str(tmpdir), 'target')
+    _writeFiles(sourcePath, ['assets/css/a.css', 'assets/css/custom.css'])
+    _writeFiles(targetPath, ['assets/css/custom.css', 'assets/css/old.css',
+        'assets/css/partials/_p.scss', 'assets/css/.svn/entries',
+        'assets/other.css'])
+    snapshot = tree_sync.TreeSnapshot(sourcePath,
+        tree_sync.ExcludeRules(['custom.css', 'partials/']),
+        roots=['assets/css'])
+
+    changes = tree_sync.syncTree(snapshot, targetPath, delete=True)
+    assert [os.path.relpath(path, targetPath)
+        for path in changes.deleted] == ['assets/css/old.css']
+    # Excluded paths, .svn and paths outside the roots are left alone.
+    assert _listFiles(targetPath) == ['assets', 'assets/css',
+        'assets/css/.svn', 'assets/css/.svn/entries', 'assets/css/a.css',
+        'assets/css/custom.css', 'assets/css/partials',
+        'assets/css/partials/_p.scss', 'assets/other.css']
+    with open(os.path.join(targetPath, 'assets/css/custom.css')) as keptFile:
+        assert keptFile.read() == 'assets/css/custom.css'
+
+def test_delete_disabled_leaves_extra_paths(tmpdir):
+    sourcePath = os.path.join(str(tmpdir), 'source')
+    targetPath = os.path.join(str(tmpdir), 'target')
+    _writeFiles(sourcePath, ['a.css'])
+    _writeFiles(targetPath, ['old.css'])
+
+    changes = tree_sync.syncTree(tree_sync.TreeSnapshot(sourcePath),
+        targetPath, delete=False)
+    assert changes.deleted == []
+    assert _listFiles(targetPath) == ['a.css', 'old.css']
@@ -0,0 +1,549 @@
+#
+# tree_sync.py
+# content-scripts
+#
+# For details and documentation:
+# http://github.com/inkling/content-scripts
+#
+# Copyright 2015 Inkling Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Syncs directory trees without shelling out to rsync.
+
+A TreeSnapshot lists a source tree, or a set of paths in it, once, so it can
+be synced into any number of targets in a single pass each without walking the
+source again. Syncing compares each file's size and modification time with the
+target's copy, falling back to comparing content hashes, and writes only the
+files that differ. The exact paths added, modified and deleted are returned so they can be
+handed to svn without a status scan of the working copy.
+
+Files are written to a temporary name and renamed over the target's copy, never
+written in place, so hardlinked copies of a file are never changed through a
+target.
+"""
+
+import codecs
+import functools
+import hashlib
+import logging
+import os
+import re
+import shutil
+import stat
+import sys
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 has scandir as a separate package. Without it directories are
+    # listed with os.listdir and os.lstat.
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from s9logging import s9logging
+
+s9logging.configureLogging()
+log = logging.getLogger(__name__)
+
+# Names never synced, deleted or descended into.
+IGNORED_NAMES = frozenset(['.svn'])
+
+# Suffix of files being written, renamed into place once complete.
+PARTIAL_SUFFIX = '.tree-sync-partial'
+
+
+class ExcludeRules(object):
+    """Include and exclude patterns in the rsync filter file format.
+
+    Each non-empty line that doesn't start with '#' or ';' is a pattern,
+    optionally prefixed with '- ' to exclude or '+ ' to include matches. The
+    first matching pattern decides, and paths matching none are included.
+    Patterns follow rsync: a leading '/' anchors the pattern to the root of the
+    transfer, a trailing '/' only matches directories, a pattern with any other
+    '/' is matched against the end of the relative path and one without is
+    matched against the name, '*' and '?' don't match '/' and '**' does.
+
+    Attributes:
+        rules - List of (include, directoryOnly, compiled pattern) tuples.
+    """
+
+    def __init__(self, lines):
+        self.rules = []
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if not line or line[0] in '#;':
+                continue
+            include = False
+            if line.startswith('+ ') or line.startswith('- '):
+                include = line[0] == '+'
+                line = line[2:]
+            directoryOnly = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            self.rules.append((include, directoryOnly, _compilePattern(line)))
+
+    @classmethod
+    def fromFile(cls, path):
+        """Returns the ExcludeRules read from an rsync exclude file.
+        """
+        with codecs.open(path, 'rb', encoding='utf8') as excludeFile:
+            return cls(excludeFile.read().splitlines())
+
+    def isExcluded(self, relativePath, isDirectory):
+        """Returns whether a path relative to the root of the transfer is
+        excluded.
+        """
+        relativePath = relativePath.replace(os.sep, '/')
+        for include, directoryOnly, pattern in self.rules:
+            if directoryOnly and not isDirectory:
+                continue
+            if pattern.search(relativePath):
+                return not include
+        return False
+
+
+class TreeSnapshot(object):
+    """The directories, files and links of a directory tree, or of some paths
+    in it.
+
+    Attributes:
+        path - Absolute path of the tree.
+        roots - List of the paths synced, relative to the tree root. A
+            directory is synced with everything under it and a file on its
+            own. The whole tree is the single root ''.
+        missing - List of roots that don't exist in the tree.
+        directories - Set of directory paths relative to the tree root,
+            including the directory roots and the directories above each root
+            that is synced.
+        files - Dict from file path relative to the tree root to its stat
+            result.
+        links - Dict from symlink path relative to the tree root to the path
+            it points to.
+        excludes - ExcludeRules the snapshot was taken with, or None. Patterns
+            are matched against paths relative to the root they're under, as
+            for a separate rsync of each root.
+        hashes - Dict from file path relative to the tree root to its content
+            hash, filled in by getFileHash.
+    """
+
+    def __init__(self, path, excludes=None, roots=None):
+        self.path = os.path.abspath(path)
+        self.roots = []
+        self.missing = []
+        self.directories = set()
+        self.files = {}
+        self.links = {}
+        self.excludes = excludes
+        self.hashes = {}
+
+        for root in roots if roots is not None else ['']:
+            root = os.path.normpath(root) if root else ''
+            rootPath = os.path.join(self.path, root)
+            if os.path.isdir(rootPath) and not os.path.islink(rootPath):
+                self.roots.append(root)
+                self._addParents(root)
+                self._read(root, root)
+            elif os.path.lexists(rootPath):
+                self.roots.append(root)
+                # An excluded file isn't synced, so neither are the
+                # directories above it.
+                if not isExcluded(excludes, os.path.basename(root), False):
+                    self._addParents(os.path.dirname(root))
+                    self._addEntry(root, os.lstat(rootPath), False, root)
+            else:
+                self.missing.append(root)
+
+    def contains(self, relativePath):
+        """Returns whether the snapshot has anything at relativePath.
+        """
+        return self.getKind(relativePath) is not None
+
+    def getKind(self, relativePath):
+        """Returns 'directory', 'file' or 'link' for what the snapshot has at
+        relativePath, or None if it has nothing there.
+        """
+        if relativePath in self.directories:
+            return 'directory'
+        if relativePath in self.files:
+            return 'file'
+        if relativePath in self.links:
+            return 'link'
+        return None
+
+    def getFileHash(self, relativePath):
+        """Returns the content hash of a file in the snapshot. Each file is
+        only read once however many targets it is compared with.
+        """
+        if relativePath not in self.hashes:
+            self.hashes[relativePath] = _getFileHash(
+                os.path.join(self.path, relativePath))
+        return self.hashes[relativePath]
+
+    def getPaths(self):
+        """Returns the set of every path in the snapshot, relative to its root.
+        """
+        return self.directories | set(self.files) | set(self.links)
+
+    def _addParents(self, relativePath):
+        while relativePath:
+            self.directories.add(relativePath)
+            relativePath = os.path.dirname(relativePath)
+
+    def _read(self, relativePath, root):
+        for name, isDirectory, childStat in _scanDirectory(
+                os.path.join(self.path, relativePath)):
+            childRelativePath = os.path.join(relativePath, name)
+            if not isExcluded(self.excludes, _getRootRelativePath(
+                    childRelativePath, root), isDirectory):
+                self._addEntry(childRelativePath, childStat, isDirectory,
+                    root)
+
+    def _addEntry(self, relativePath, entryStat, isDirectory, root):
+        if stat.S_ISLNK(entryStat.st_mode):
+            self.links[relativePath] = os.readlink(
+                os.path.join(self.path, relativePath))
+        elif isDirectory:
+            self.directories.add(relativePath)
+            self._read(relativePath, root)
+        else:
+            self.files[relativePath] = entryStat
+
+
+class TreeChanges(object):
+    """The changes made to a target by a sync.
+
+    Attributes:
+        added - List of absolute paths of files, links and directories that
+            didn't exist in the target.
+        modified - List of absolute paths of files and links that were
+            rewritten.
+        deleted - List of absolute paths removed from the target. Paths under
+            a removed directory aren't listed separately.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.modified = []
+        self.deleted = []
+
+    def __len__(self):
+        return len(self.added) + len(self.modified) + len(self.deleted)
+
+    def extend(self, changes):
+        """Adds the changes of another sync to these.
+        """
+        self.added.extend(changes.added)
+        self.modified.extend(changes.modified)
+        self.deleted.extend(changes.deleted)
+
+
+def isExcluded(excludes, relativePath, isDirectory):
+    """Returns whether relativePath is excluded by excludes, which may be None.
+    """
+    return excludes is not None and excludes.isExcluded(relativePath,
+        isDirectory)
+
+
+def syncTree(snapshot, destinationPath, delete=True, link=False,
+        checksum=False):
+    """Makes the tree at destinationPath match a snapshot, writing only files
+    that differ. IGNORED_NAMES and paths excluded from the snapshot are left
+    alone in the destination.
+
+    Args:
+        snapshot - TreeSnapshot of the source tree.
+        destinationPath - String path of the tree to update. Created if it
+            doesn't exist.
+        delete - If True, remove files and directories that aren't in the
+            snapshot, as rsync --delete does.
+        link - If True, hardlink files to the source tree where the
+            filesystem allows it rather than copying them.
+        checksum - If True, files of the same size but different modification
+            times are compared by content hash, and only have their time
+            updated if their content is the same. Each source file is hashed
+            at most once per snapshot.
+
+    Returns:
+        The TreeChanges made to the destination.
+    """
+    changes = TreeChanges()
+
+    if not os.path.isdir(destinationPath):
+        changes.added.append(_makeDirectories(destinationPath))
+    for relativePath in sorted(snapshot.directories):
+        targetPath = os.path.join(destinationPath, relativePath)
+        if os.path.islink(targetPath) or not os.path.isdir(targetPath):
+            if _remove(targetPath):
+                changes.deleted.append(targetPath)
+            os.mkdir(targetPath)
+            changes.added.append(targetPath)
+
+    for relativePath, sourceStat in sorted(snapshot.files.items()):
+        _syncFile(os.path.join(snapshot.path, relativePath), sourceStat,
+            os.path.join(destinationPath, relativePath), link, checksum,
+            changes, functools.partial(snapshot.getFileHash, relativePath))
+
+    for relativePath, linkPath in sorted(snapshot.links.items()):
+        targetPath = os.path.join(destinationPath, relativePath)
+        if os.path.islink(targetPath):
+            if os.readlink(targetPath) == linkPath:
+                continue
+            changes.modified.append(targetPath)
+        else:
+            if _remove(targetPath):
+                changes.deleted.append(targetPath)
+            changes.added.append(targetPath)
+        _remove(targetPath)
+        os.symlink(linkPath, targetPath)
+
+    if delete:
+        for root in snapshot.roots:
+            if root in snapshot.directories or not root:
+                _removeExtraneous(snapshot, destinationPath, root, root,
+                    changes)
+
+    return changes
+
+
+def diffSnapshots(before, after):
+    """Returns the changes between two snapshots of the same tree, such as
+    one taken before and one after running a tool that writes into it.
+    Files are compared by size and modification time.
+    """
+    changes = TreeChanges()
+    for relativePath in sorted(after.getPaths()):
+        afterPath = os.path.join(after.path, relativePath)
+        beforeKind = before.getKind(relativePath)
+        afterKind = after.getKind(relativePath)
+        if beforeKind is None:
+            changes.added.append(afterPath)
+        elif beforeKind != afterKind:
+            changes.deleted.append(afterPath)
+            changes.added.append(afterPath)
+        elif afterKind == 'file':
+            beforeStat = before.files[relativePath]
+            afterStat = after.files[relativePath]
+            if (beforeStat.st_size != afterStat.st_size or
+                    beforeStat.st_mtime != afterStat.st_mtime):
+                changes.modified.append(afterPath)
+        elif (afterKind == 'link' and
+                before.links[relativePath] != after.links[relativePath]):
+            changes.modified.append(afterPath)
+    for relativePath in sorted(before.getPaths()):
+        if after.getKind(relativePath) is None:
+            changes.deleted.append(os.path.join(after.path, relativePath))
+    return changes
+
+
+def syncFile(sourcePath, destinationPath, link=False, checksum=False):
+    """Makes destinationPath a copy of the file at sourcePath if it differs,
+    creating its parent directories as needed.
+
+    Args:
+        sourcePath - String path of the source file.
+        destinationPath - String path of the file to update.
+        link, checksum - As for syncTree.
+
+    Returns:
+        The TreeChanges made to the destination.
+    """
+    changes = TreeChanges()
+    parentPath = os.path.dirname(os.path.abspath(destinationPath))
+    if not os.path.isdir(parentPath):
+        changes.added.append(_makeDirectories(parentPath))
+    _syncFile(sourcePath, os.lstat(sourcePath), destinationPath, link,
+        checksum, changes, functools.partial(_getFileHash, sourcePath))
+    return changes
+
+
+def _syncFile(sourcePath, sourceStat, targetPath, link, checksum, changes,
+        getSourceHash):
+    """Replaces the file at targetPath with a copy or hardlink of sourcePath
+    unless they match, recording the change in changes.
+
+    A target with the source's size and exact modification time is taken to
+    match. With checksum, other targets of the same size are compared by
+    content hash, and given the source's time if they match so later syncs
+    needn't read them again. getSourceHash returns the source's hash.
+    """
+    try:
+        targetStat = os.lstat(targetPath)
+    except OSError:
+        targetStat = None
+
+    if targetStat is not None and stat.S_ISREG(targetStat.st_mode):
+        if targetStat.st_size == sourceStat.st_size:
+            if _isSameModificationTime(targetStat, sourceStat):
+                return
+            if checksum and (_isSameFile(targetStat, sourceStat) or
+                    getSourceHash() == _getFileHash(targetPath)):
+                _setModificationTime(targetPath, sourceStat)
+                return
+        changes.modified.append(targetPath)
+    else:
+        if targetStat is not None:
+            _remove(targetPath)
+            changes.deleted.append(targetPath)
+        changes.added.append(targetPath)
+
+    partialPath = targetPath + PARTIAL_SUFFIX
+    _remove(partialPath)
+    if link:
+        try:
+            os.link(sourcePath, partialPath)
+        except OSError:
+            link = False
+    if not link:
+        shutil.copy2(sourcePath, partialPath)
+    os.rename(partialPath, targetPath)
+
+
+def _makeDirectories(path):
+    """Creates the directory at path along with any missing parents, returning
+    the absolute path of the outermost directory created.
+    """
+    createdPath = os.path.abspath(path)
+    while not os.path.isdir(os.path.dirname(createdPath)):
+        createdPath = os.path.dirname(createdPath)
+    os.makedirs(path)
+    return createdPath
+
+
+def _removeExtraneous(snapshot, destinationPath, relativePath, root,
+        changes):
+    """Removes everything under relativePath in the destination that isn't in
+    the snapshot or excluded from it, recording the removed paths in changes.
+    """
+    for name, isDirectory, _ in _scanDirectory(
+            os.path.join(destinationPath, relativePath)):
+        childRelativePath = os.path.join(relativePath, name)
+        if isExcluded(snapshot.excludes, _getRootRelativePath(
+                childRelativePath, root), isDirectory):
+            continue
+        if childRelativePath in snapshot.directories:
+            _removeExtraneous(snapshot, destinationPath, childRelativePath,
+                root, changes)
+        elif not snapshot.contains(childRelativePath):
+            childPath = os.path.join(destinationPath, childRelativePath)
+            _remove(childPath)
+            changes.deleted.append(childPath)
+
+
+def _getRootRelativePath(relativePath, root):
+    """Returns a path relative to the tree root as relative to the root of the
+    snapshot it's under.
+    """
+    return relativePath[len(root) + 1:] if root else relativePath
+
+
+def _scanDirectory(path):
+    """Yields the (name, whether it is a directory, lstat result) of each entry
+    of a directory except IGNORED_NAMES. Links to directories are not
+    directories.
+    """
+    if scandir is None:
+        for name in os.listdir(path):
+            if name not in IGNORED_NAMES:
+                entryStat = os.lstat(os.path.join(path, name))
+                yield name, stat.S_ISDIR(entryStat.st_mode), entryStat
+        return
+
+    for entry in scandir(path):
+        if entry.name not in IGNORED_NAMES:
+            entryStat = entry.stat(follow_symlinks=False)
+            yield entry.name, stat.S_ISDIR(entryStat.st_mode), entryStat
+
+
+def _compilePattern(pattern):
+    """Returns a compiled regular expression for an rsync filter pattern.
+    """
+    anchored = pattern.startswith('/')
+    pattern = pattern.lstrip('/')
+    expression = ''
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith('**', index):
+            expression += '.*'
+            index += 2
+            continue
+        character = pattern[index]
+        if character == '*':
+            expression += '[^/]*'
+        elif character == '?':
+            expression += '[^/]'
+        elif character == '[':
+            end = pattern.find(']', index + 2)
+            if end < 0:
+                expression += re.escape(character)
+            else:
+                characterClass = pattern[index + 1:end]
+                if characterClass.startswith('!'):
+                    characterClass = '^' + characterClass[1:]
+                expression += '[' + characterClass + ']'
+                index = end
+        else:
+            expression += re.escape(character)
+        index += 1
+    return re.compile(('^' if anchored else '(?:^|/)') + expression + '$')
+
+
+def _isSameModificationTime(firstStat, secondStat):
+    # Python 3 has exact nanosecond times, which copy2 preserves. The Python 2
+    # scandir package has them too, but os.lstat doesn't.
+    if (hasattr(firstStat, 'st_mtime_ns') and
+            hasattr(secondStat, 'st_mtime_ns')):
+        return firstStat.st_mtime_ns == secondStat.st_mtime_ns
+    # Python 2 only sets times to the microsecond, and its float times lose
+    # a little more.
+    return abs(firstStat.st_mtime - secondStat.st_mtime) < 2e-6
+
+
+def _setModificationTime(path, pathStat):
+    # Set nanosecond times where Python has them, so they compare equal.
+    if sys.version_info[0] >= 3:
+        os.utime(path, ns=(pathStat.st_atime_ns, pathStat.st_mtime_ns))
+    else:
+        os.utime(path, (pathStat.st_atime, pathStat.st_mtime))
+
+
+def _isSameFile(firstStat, secondStat):
+    """Returns whether two stat results are of the same file, such as a
+    hardlink and its source.
+    """
+    return (firstStat.st_ino == secondStat.st_ino and
+        firstStat.st_dev == secondStat.st_dev)
+
+
+def _getFileHash(path):
+    fileHash = hashlib.sha1()
+    with open(path, 'rb') as hashedFile:
+        for chunk in iter(lambda: hashedFile.read(1024 * 1024), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+def _remove(path):
+    """Removes the file, link or directory tree at path, returning whether
+    there was anything to remove.
+    """
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        return False
+    return True